@@ -23,18 +23,39 @@
 # Revised On: Nov  1, 2020 V2 - New calendar, new problems
 #             Dec 20, 2020 V3 - Path of Pain
 
+from time import perf_counter
+_MODULE_START = perf_counter()
+
 import argparse
-from datetime import datetime, time, timedelta
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from datetime import date, datetime
+from itertools import chain
+import json
 import os
-from pytz import timezone
 import re
+import struct
+import sys
+from zoneinfo import ZoneInfo
+
+# pandas (Excel files) and icalendar (.ics files) are slow to import, so they
+# are imported by the stages that use them rather than up here. Keep it that
+# way: '--help' and small runs should not pay for them
 
-from icalendar import Calendar, Event   # For .ics files
-from icalendar.prop import vText
-from pandas import read_excel           # For Excel files
+# Time allowed from the start of this module to the first stage of main(),
+# interpreter startup excluded. Reported (and warned about) by --timings
+STARTUP_BUDGET = 0.1
 
 # Timezone data
-EASTERN = timezone("Canada/Eastern")
+EASTERN = ZoneInfo("Canada/Eastern")
+
+# Integer time representation. Session slots are stored as minutes since the
+# Unix epoch (UTC) so that week arithmetic and equality checks are plain
+# integer operations
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+EPOCH_WEEKDAY = date(1970, 1, 1).weekday()
 
 # Days of week for datetime
 MONDAY = 0
@@ -87,86 +108,6 @@ DECEMBER = 12
 
 # Unique ID generation for calendar events
 UID = 0x040000008200E00074C5B7101A82E00800000000B018367A1691D3010000000000000000100000006AC9A0BE63E24944931F7635DF2D1C2E
-UID_COUNTER = 0
-
-# Custom colours for non-clinic events
-NON_CLINIC_COLOUR_KEY = {
-    "Lunch": vText("Yellow Category"),
-    "Lunch ": vText("Yellow Category"),
-    "Student Vendor Fair": vText("Green Category"),
-    "Graduation Day": vText("Green Category"),
-    "Winter Holidays ": vText("Green Category"),
-    "Civic Holiday": vText("Green Category"),
-    "CDSC Conference - Classes and Clinics Cancelled ": vText("Green Category"),
-    "ODA Annual Spring Meeting ": vText("Green Category"),
-    "Fall Study Day - Classes and Clinics Cancelled ": vText("Green Category"),
-    "Canada Day - University Closed": vText("Green Category"),
-    "Classes begin": vText("Green Category"),
-    "Reading Week": vText("Green Category"),
-    "Clinics close": vText("Green Category"),
-    "Summer session begins": vText("Green Category"),
-    "Classes end": vText("Green Category"),
-    "Classes end and clinics close": vText("Green Category"),
-    "Orientation Week": vText("Green Category"),
-    "Thanksgiving Day": vText("Green Category"),
-    "Labour day": vText("Green Category"),
-    "Family Day": vText("Green Category"),
-    "Victoria Day": vText("Green Category"),
-    "Good Friday": vText("Green Category"),
-    "Oral Medicine and Pathology - Seminars (14) - DEN315Y1": vText("Purple Category"),
-    "IPC Distribution and Information ": vText("Red Category"),
-    "Dental Public Health (DEN308Y) - Term Test": vText("Blue Category"),
-    "Psychiatry and Dentistry - Test": vText("Blue Category"),
-    "InterProfessional Pain Curriculum ": vText("Red Category"),
-    "Oral Diagnosis & Medicine (DEN356Y) - Term Test": vText("Blue Category"),
-    "Practice Administration (DEN409Y) - Term Test": vText("Blue Category"),
-    "Oral Surgery (DEN318Y) - Term Test": vText("Blue Category"),
-    "Pediatric Dentistry (DEN323Y) - Term Test": vText("Blue Category"),
-    "Oral Med & Pathology (DEN315Y) ": vText("Blue Category"),
-    "Prosthodontics (DEN333Y) - Term Test": vText("Blue Category"),
-    "Oral Radiology (DEN317Y) - Term Test": vText("Blue Category"),
-    "Anesthesia (DEN301Y) - Term Test": vText("Blue Category"),
-    "Orthodontics (DEN322Y) - Term Test": vText("Blue Category"),
-    "Endodontics (DEN303H) - Term Test": vText("Blue Category"),
-    "Pharmacology (DEN327H) - Term Test": vText("Blue Category"),
-    "DEN322Y1 Orthodontic - Final Exam": vText("Blue Category"),
-    "DEN333Y1 Prosthodontics - Final Exam": vText("Blue Category"),
-    "DEN315Y1 Oral Medicine & Pathology - Final Exam": vText("Blue Category"),
-    "DEN323Y1 Pediatric Dentistry - Final Exam": vText("Blue Category"),
-    "DEN336Y1 Restorative Dentistry - Final Exam": vText("Blue Category"),
-    "Oral Radiology - part 1 - Final Exam": vText("Blue Category"),
-    "Oral Radiology - part 2 - Final Exam": vText("Blue Category"),
-    "Oral Radiology - Part 1 & 2 - Final Exam": vText("Blue Category"),
-    "Anesthesia (DEN301H1) - Final Exam": vText("Blue Category"),
-    "Pharmacology (DEN327H1) - Final Exam": vText("Blue Category"),
-    "Endodontics (DEN303H1) - Final Exam": vText("Blue Category"),
-    "Final Exam Period": vText("Blue Category"),
-    "Periodontics (DEN324H) - Term Test": vText("Blue Category"),
-    "Restorative (DEN336Y) - Term Test": vText("Blue Category"),
-    "InterProfessional Pain Curriculum (1)": vText("Red Category"),
-    "Research Day": vText("Green Category"),
-    "DEN318Y1 Oral and Maxillofacial Surgery - Final Exam ": vText("Blue Category"),
-    "Comprehensive Care - DEN451Y - Term Test": vText("Blue Category"),
-    "Orthodontics - DEN465Y1 - Term Test": vText("Blue Category"),
-    "Oral Radiology - DEN459Y1 - Term Test": vText("Blue Category"),
-    "Oral Surgery - DEN462Y1 - Final Exam": vText("Blue Category"),
-    "Pediatric Dentistry - DEN468Y - Term Test": vText("Blue Category"),
-    "Comprehensive Care - DEN451Y - Test": vText("Blue Category"),
-    "Practice Administration - Test": vText("Blue Category"),
-    "Endodontics - DEN453Y1 - Term Test": vText("Blue Category"),
-    "Anesthesia - DEN400H - Final Exam": vText("Blue Category"),
-    "Dean's Welcome Back!": vText("Purple Category"),
-    "IPE Orientation": vText("Purple Category"),
-    "Orthodontics Screening": vText("Orange Category"),
-    "Labour Day (University Closed)": vText("Green Category"),
-    "Thanksgiving Day (University Closed)": vText("Green Category"),
-    "Fall Study Day": vText("Green Category"),
-    "Winter Holidays (University Closed)": vText("Green Category"),
-    "Family Day (University Closed)": vText("Green Category"),
-    "Study Day for NDEB Examinations": vText("Green Category"),
-    "Good Friday (University Closed)": vText("Green Category"),
-    "Oral Examination Period": vText("Blue Category")
-}
 
 class CheckFileAction(argparse.Action):
     """Ensures that file exists and is OK to read/write"""
@@ -175,20 +116,192 @@ class CheckFileAction(argparse.Action):
         # It is actually better to open a file than it is to check existance,
         # else it could lead to annoying bugs (Why can't it find my file?!?!?
         # It's clearly right there you stupid program!)
-        try:
-            handle = open(values)
-        except IOError as e:
-            parser.error(e)
-        else:
-            handle.close()
+        if values is not None: # Optional positional left out
+            try:
+                handle = open(values)
+            except IOError as e:
+                parser.error(e)
+            else:
+                handle.close()
         setattr(namespace, self.dest, values)
 
+def commaList(text):
+    """argparse type for comma-separated values"""
+    return [value.strip() for value in text.split(",") if value.strip()]
+
 class CheckModeAction(argparse.Action):
     """Ensures that mode is in proper format"""
     
     def __call__(self, parser, namespace, values, option_string=None):
-        if values not in ["All", "Clinics"]:
-            parser.error("Invalid mode: {}; expected either 'All' or 'Clinics'"
+        if values not in ["All", "Clinics", "Shared"]:
+            parser.error("Invalid mode: {}; expected 'All', 'Clinics' or 'Shared'"
+                            "".format(values))
+        setattr(namespace, self.dest, values)
+
+class DSTTable:
+    """Precomputed UTC offsets for a timezone, used to convert between local
+    wall-clock time and epoch minutes with a bisect instead of a tzinfo call.
+    
+    Members:
+        timezone (datetime.tzinfo)
+            The timezone being tabulated
+        transitions (list(int))
+            Epoch minutes (UTC) at which the UTC offset changes
+        localTransitions (list(int))
+            Local wall-clock minutes at which the offset used to interpret a
+            local time changes (see localToEpochMinutes)
+        offsets (list(int))
+            UTC offset in minutes; offsets[i] applies before transitions[i]
+            and offsets[-1] after the last one
+        firstYear, lastYear (int)
+            Range of years currently covered by the table
+    
+    The table covers whole years and is extended on demand, so building it
+    for the academic year costs a few dozen tzinfo calls, once.
+    """
+    
+    def __init__(self, timezone, firstYear=2020, lastYear=2021):
+        self.timezone = timezone
+        self.firstYear = firstYear
+        self.lastYear = lastYear
+        self._build()
+    
+    def _offset(self, epochMinutes):
+        """UTC offset in minutes at the given epoch minute (the slow way)"""
+        dt = datetime.fromtimestamp(epochMinutes * 60, self.timezone)
+        return int(dt.utcoffset().total_seconds()) // 60
+    
+    def _build(self):
+        """(Re)compute the transition table for [firstYear, lastYear]"""
+        
+        # Sample the offset at the start of every month and bisect down to the
+        # minute wherever it changes
+        samples = []
+        for year in range(self.firstYear, self.lastYear + 2):
+            for month in range(JANUARY, DECEMBER + 1):
+                samples.append((date(year, month, 1).toordinal() - EPOCH_ORDINAL) * MINUTES_PER_DAY)
+                if year == self.lastYear + 1:
+                    break
+        self.lo = samples[0]
+        self.hi = samples[-1]
+        
+        self.transitions = []
+        self.offsets = [self._offset(samples[0])]
+        for (a, b) in zip(samples, samples[1:]):
+            after = self._offset(b)
+            if after == self.offsets[-1]:
+                continue
+            while b - a > 1:
+                mid = (a + b) // 2
+                if self._offset(mid) == after:
+                    b = mid
+                else:
+                    a = mid
+            self.transitions.append(b)
+            self.offsets.append(after)
+        
+        # A local time maps to the offset in effect before a transition until
+        # the wall clock passes the later of the two readings, which resolves
+        # both the repeated hour in November and the skipped hour in March the
+        # same way zoneinfo does for fold=0
+        self.localTransitions = [t + max(before, after) for (t, before, after)
+                                 in zip(self.transitions, self.offsets, self.offsets[1:])]
+    
+    def _cover(self, epochMinutes):
+        """Extend the table if the given minute lies outside of it"""
+        if self.lo <= epochMinutes < self.hi:
+            return
+        year = 1970 + epochMinutes // (MINUTES_PER_DAY * 365)
+        self.firstYear = min(self.firstYear, year - 1)
+        self.lastYear = max(self.lastYear, year + 1)
+        self._build()
+    
+    def offsetAt(self, epochMinutes):
+        """UTC offset in minutes in effect at the given epoch minute"""
+        self._cover(epochMinutes)
+        return self.offsets[bisect_right(self.transitions, epochMinutes)]
+    
+    def localOffset(self, localMinutes):
+        """UTC offset in minutes to use for the given local wall-clock minute"""
+        self._cover(localMinutes)
+        return self.offsets[bisect_right(self.localTransitions, localMinutes)]
+
+# DST transitions for the academic year (extended automatically if needed)
+EASTERN_DST = DSTTable(EASTERN)
+
+def localToEpochMinutes(year, month, day, hour, minute, dstTable=EASTERN_DST):
+    """Converts a local wall-clock time into minutes since the epoch (UTC)
+    
+    year, month, day, hour, minute (int)
+        Local date and time
+    dstTable (DSTTable) [EASTERN_DST]
+        Transition table of the desired timezone
+    returns (int)
+        Epoch minutes
+    """
+    local = (date(year, month, day).toordinal() - EPOCH_ORDINAL) * MINUTES_PER_DAY \
+          + hour * 60 + minute
+    return local - dstTable.localOffset(local)
+
+def epochMinutesToDatetime(epochMinutes, dstTable=EASTERN_DST):
+    """Converts epoch minutes back into an aware datetime for output
+    
+    epochMinutes (int)
+        Minutes since the epoch (UTC)
+    dstTable (DSTTable) [EASTERN_DST]
+        Transition table of the desired timezone
+    returns (datetime)
+        The same instant in the table's timezone
+    """
+    return datetime.fromtimestamp(epochMinutes * 60, dstTable.timezone)
+
+def exportTime(epochMinutes, allDay=False, duration=0, dstTable=EASTERN_DST):
+    """Formats a time for JSON exports: ISO 8601 with the UTC offset, or just
+    the date for all-day events
+    
+    epochMinutes (int)
+        Minutes since the epoch (UTC)
+    allDay (bool) [False]
+        Whether only the date counts
+    duration (int) [0]
+        Minutes to add first (whole days for all-day events, which would
+        otherwise be thrown off by DST changes)
+    dstTable (DSTTable) [EASTERN_DST]
+        Transition table of the desired timezone
+    returns (str)
+    """
+    if allDay:
+        day = epochMinutesToDatetime(epochMinutes, dstTable).date()
+        return date.fromordinal(day.toordinal() + duration // MINUTES_PER_DAY).isoformat()
+    return epochMinutesToDatetime(epochMinutes + duration, dstTable).isoformat()
+
+def minuteOfDay(epochMinutes, dstTable=EASTERN_DST):
+    """Local wall-clock minute of the day (e.g. 16:30 -> 990)
+    
+    epochMinutes (int)
+        Minutes since the epoch (UTC)
+    dstTable (DSTTable) [EASTERN_DST]
+        Transition table of the desired timezone
+    returns (int)
+        Minutes since local midnight
+    """
+    return (epochMinutes + dstTable.offsetAt(epochMinutes)) % MINUTES_PER_DAY
+
+class CheckArchiveAction(argparse.Action):
+    """Ensures that the archive is a format we can write"""
+    
+    def __call__(self, parser, namespace, values, option_string=None):
+        if archiveFormat(values) is None:
+            parser.error("Invalid archive: {}; expected one of {}"
+                            "".format(values, ", ".join(ARCHIVE_FORMATS)))
+        setattr(namespace, self.dest, values)
+
+class CheckLevelAction(argparse.Action):
+    """Ensures that a compression level is between 0 and 9"""
+    
+    def __call__(self, parser, namespace, values, option_string=None):
+        if not 0 <= values <= 9:
+            parser.error("Invalid compression level: {}; expected 0-9"
                             "".format(values))
         setattr(namespace, self.dest, values)
 
@@ -604,6 +717,209 @@ def getEndTime(month, day, time, weekday, studentClinicID, clinicKey):
             elif time == "PM2":       # AGP session
                 return (19, 00)
 
+# Where the clinic catalogue lives unless --catalogue says otherwise
+CLINIC_CATALOGUE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     "ClinicCatalogue.json")
+
+class ClinicCatalogue:
+    """What each clinic key string from the Excel file means, read from a
+    JSON catalogue and compiled into flat lookup tables.
+    
+    Each catalogue entry has a summary, room, description and colour. A room
+    or description is either a string or a rule object choosing between
+    strings by half of the day ("AM", "PM" - whether the session starts
+    before noon) and/or weekday ("Mon" ... "Fri"), with "default" as the
+    fallback, e.g.
+        "description": {"PM": "Arrive by 2:00 PM",
+                        "AM": {"Mon": "Arrive by 9:30 AM", "default": "..."}}
+    Rules are resolved for every (key, weekday, half) up front, so building a
+    session is a single dictionary lookup.
+    
+    Members:
+        summaries (dict(str: str))
+            Clinic key to summary
+        colours (dict(str: str))
+            Clinic key to colour category
+        sessionTable (dict(tuple(str, int, bool): tuple(str, str, str, str)))
+            (Clinic key, weekday, starts after noon) to
+            (summary, room, description, colour)
+        duplicates (list(str))
+            Keys defined more than once in the catalogue (the last wins)
+        unknown (dict(str: int))
+            Keys looked up so far that the catalogue doesn't have, and how
+            many times
+    """
+    
+    # The shared, lazily loaded default catalogue
+    _default = None
+    
+    def __init__(self, entries, duplicates=()):
+        self.summaries = {}
+        self.colours = {}
+        self.sessionTable = {}
+        self.duplicates = list(duplicates)
+        self.unknown = {}
+        for (clinicKey, entry) in entries.items():
+            self.summaries[clinicKey] = entry["summary"]
+            self.colours[clinicKey] = entry["colour"]
+            for weekday in range(MONDAY, FRIDAY + 1):
+                for afternoon in (False, True):
+                    self.sessionTable[(clinicKey, weekday, afternoon)] = (
+                        entry["summary"],
+                        ClinicCatalogue.resolve(entry["room"], weekday, afternoon),
+                        ClinicCatalogue.resolve(entry["description"], weekday, afternoon),
+                        entry["colour"])
+    
+    @staticmethod
+    def resolve(rule, weekday, afternoon):
+        """Picks the string a room/description rule gives for a session
+        
+        rule (str or dict)
+            See class description
+        weekday (MONDAY,...,FRIDAY)
+            Which weekday
+        afternoon (bool)
+            Whether the session starts at or after noon
+        returns (str)
+        """
+        weekdayName = [name for (name, day) in WEEKDAYS.items() if day == weekday][0]
+        while isinstance(rule, dict):
+            unknown = set(rule) - set(WEEKDAYS) - {"AM", "PM", "default"}
+            if unknown:
+                raise ValueError("Unknown clinic catalogue rule: {}".format(
+                                    ", ".join(sorted(unknown))))
+            half = "PM" if afternoon else "AM"
+            if half in rule:
+                rule = rule[half]
+            elif weekdayName in rule:
+                rule = rule[weekdayName]
+            else:
+                rule = rule.get("default", "")
+        return rule
+    
+    @staticmethod
+    def load(catalogueFile=CLINIC_CATALOGUE_FILE, warn=sys.stderr):
+        """Reads and compiles a catalogue, reporting duplicate keys
+        
+        catalogueFile (str)
+            JSON file to read
+        warn (file or None) [sys.stderr]
+            Where duplicate keys are reported
+        returns (ClinicCatalogue)
+        """
+        duplicates = []
+        def checkPairs(pairs):
+            seen = set()
+            for (key, value) in pairs:
+                if key in seen:
+                    duplicates.append(key)
+                seen.add(key)
+            return dict(pairs)
+        
+        with open(catalogueFile) as handle:
+            entries = json.load(handle, object_pairs_hook=checkPairs)
+        if warn is not None:
+            for key in duplicates:
+                warn.write("warning: '{}' is defined more than once in {}; "
+                           "using the last definition\n".format(key, catalogueFile))
+        return ClinicCatalogue(entries, duplicates)
+    
+    @staticmethod
+    def default():
+        """The catalogue next to this script, loaded on first use"""
+        if ClinicCatalogue._default is None:
+            ClinicCatalogue._default = ClinicCatalogue.load()
+        return ClinicCatalogue._default
+    
+    def lookup(self, clinicKey, weekday, afternoon):
+        """(summary, room, description, colour) for one session; unknown keys
+        are passed through as their own summary"""
+        try:
+            return self.sessionTable[(clinicKey, weekday, afternoon)]
+        except KeyError:
+            self.unknown[clinicKey] = self.unknown.get(clinicKey, 0) + 1
+            return (clinicKey, "", "", "")
+
+# Where the colour rules for non-clinic events live unless --rules says otherwise
+CATEGORY_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "CategoryRules.json")
+
+class CategoryRules:
+    """Picks colour categories for non-clinic events from their summaries.
+    
+    The rules are an ordered JSON list of {"pattern": regex, "category": str}
+    objects. Patterns are matched case-insensitively against the start of the
+    summary with surrounding spaces removed ("Lunch" and "Lunch " are the
+    same), and the first matching rule wins. A null category keeps the
+    event's own category without reporting it as uncategorized. All patterns
+    are compiled into a single regular expression, and every distinct summary
+    is only classified once.
+    
+    Members:
+        rules (list(tuple(str, str)))
+            (Pattern, category) in order
+        uncategorized (set(str))
+            Summaries seen so far that no rule matched
+    """
+    
+    # The shared, lazily loaded default rules
+    _default = None
+    
+    def __init__(self, rules):
+        self.rules = [(rule["pattern"], rule["category"]) for rule in rules]
+        self.uncategorized = set()
+        self._cache = {}
+        self._matcher = re.compile("|".join("(?P<r{}>{})".format(i, pattern)
+                                            for (i, (pattern, _)) in enumerate(self.rules)),
+                                   re.IGNORECASE)
+    
+    @staticmethod
+    def load(rulesFile=CATEGORY_RULES_FILE):
+        """Reads and compiles a rules file
+        
+        rulesFile (str)
+            JSON file to read
+        returns (CategoryRules)
+        """
+        with open(rulesFile) as handle:
+            return CategoryRules(json.load(handle))
+    
+    @staticmethod
+    def default():
+        """The rules next to this script, loaded on first use"""
+        if CategoryRules._default is None:
+            CategoryRules._default = CategoryRules.load()
+        return CategoryRules._default
+    
+    def categorize(self, summary):
+        """Returns the category for 'summary', or None to keep its own"""
+        try:
+            return self._cache[summary]
+        except KeyError:
+            pass
+        
+        match = self._matcher.match(summary.strip())
+        if match is None:
+            category = None
+            self.uncategorized.add(summary)
+        else:
+            category = self.rules[int(match.lastgroup[1:])][1]
+        self._cache[summary] = category
+        return category
+    
+    @staticmethod
+    def report(uncategorized, handle=sys.stderr):
+        """Lists summaries no rule matched, if any
+        
+        uncategorized (set(str))
+            Summaries no rule matched, from every calendar of the run
+        handle (file) [sys.stderr]
+            Where to list them
+        """
+        if uncategorized:
+            handle.write("warning: no category rule for: {}\n".format(
+                ", ".join(repr(summary) for summary in sorted(uncategorized))))
+
 class Session:
     """Used to hold clinical session data.
     
@@ -614,297 +930,69 @@ class Session:
             What room the clinic is in
         description (str)
             Any details about the session
-        start (datetime)
-            Time clinic starts
-        end (datetime)
-            Time clinic ends
-            
-    Static members:
-        CLINIC_KEY (dict(str: tuple(str, (lambda int, str), (lambda int, str))))
-            Provides information about a particular clinic key string
-            
-        CLINIC_COLOUR_KEY(dict(str: icalendar.prop.vText))
-            Creates an '''unique''' colour for each clinic key string
+        start (int)
+            Time clinic starts, in epoch minutes
+        end (int)
+            Time clinic ends, in epoch minutes
+        colour (str)
+            Colour category of the clinic
+        slot (str or None)
+            Which session of the day it is in the clinic schedule ("AM",
+            "PM1" or "PM2"; Friday's "PM" is "PM1")
     
     Static methods:
         createSession(clinic, ID, start, end)
             Helper method to create a Session class
     """
     
-    # Given a clinic symbol, provide what it means, room, and description
-    CLINIC_KEY = {
-        "FT": ("Faculty Timetable",          # Summary
-                (lambda ID, start: "NA"),    # Room
-                (lambda ID, start: "")),     # Description
-        "C1": ("CCP - Clinic 1",
-                (lambda ID, start: "Clinic 1"), 
-                (lambda ID, start: "")),
-        "C2": ("CCP - Clinic 2", 
-                (lambda ID, start: "Clinic 2"), 
-                (lambda ID, start: "")),
-        "CH": ("Pediatric Clinic", 
-                (lambda ID, start: "Pediatric Clinic - 1st floor"), 
-                (lambda ID, start: "")),
-        "EM": ("Emergency Clinic", 
-                (lambda ID, start: "Emergency Clinic - 2nd floor"), 
-                (lambda ID, start: "")),
-        "OD": ("Oral Diagnosis Clinic", 
-                (lambda ID, start: "Oral Diagnosis Clinic - 2nd floor"), 
-                (lambda ID, start: "")),
-        "OR": ("Orthodontics Clinic", 
-                (lambda ID, start: "481 University Avenue - 4th floor"), 
-                (lambda ID, start: "")),
-        "RA": ("Radiology Clinic", 
-                (lambda ID, start: "Radiology Clinic - 2nd floor"), 
-                (lambda ID, start: "")),
-        "SC": ("Oral Surgery Clinic", 
-                (lambda ID, start: "Oral Surgery Clinic - 1st floor"), 
-                (lambda ID, start: "")),
-        "HR": ("Hospital Rotations", 
-                (lambda ID, start: "See Clinic Office Schedule"), # Done via hospitalFile parameter
-                (lambda ID, start: "")),
-        "GB": ("George Brown Health Sciences", 
-                (lambda ID, start: "51 Dockside Drive (Take #6 bus on Bay St.)"),
-                # Silly lambda's, have to do reverse if statemeent structure
-                (lambda ID, start: \
-                    "Arrive by 11:30 AM" \
-                    if start.weekday() == MONDAY \
-                    else "Arrive by 7:30 AM" \
-                    if start.weekday() == TUESDAY \
-                    else "")),
-        "CA": ("CAMH Rotation", 
-                (lambda ID, start: "100 Stokes Street - via Queen Street West"), 
-                (lambda ID, start: \
-                    "Placement begins at 9:15 AM" \
-                    if start.time() < time(12) \
-                    else "Placement begins at 1:15 AM")),
-        "Ge": ("Assist in Grad Endo", 
-                (lambda ID, start: "Grad Endo Clinics - 2nd floor"), 
-                (lambda ID, start: "")),
-        "Go": ("Assist in Oral Reconstruction", 
-                (lambda ID, start: "Grad Perio/ORC Clinics - 3rd floor"), 
-                (lambda ID, start: "")),
-        "Gp": ("Assist in Grad Perio", 
-                (lambda ID, start: "Grad Perio/ORC Clinics - 3rd floor"), 
-                (lambda ID, start: \
-                    # If PM Session:
-                    "Arrive by 2:00 PM" \
-                    if start.time() >= time(12) \
-                    # If AM Session:
-                    else \
-                        # Then determine which weekday
-                        "Arrive by 9:30 AM" \
-                        if start.weekday() == MONDAY \
-                        else "Arrive by 10:00 AM" \
-                        if start.weekday() == TUESDAY \
-                        else "Arrive by 8:30 AM" \
-                        if start.weekday() == WEDNESDAY \
-                        else "Arrive by 8:30 AM" \
-                        if start.weekday() == THURSDAY \
-                        else "Arrive by 10:00 AM")),
-        "Gpr": ("Assist in Grad Prostho", 
-                (lambda ID, start: "Grad Prostho Clinics - 3rd floor"), 
-                (lambda ID, start: "")),
-        "SM": ("St. Michael's Hospital Rotation", 
-                (lambda ID, start: "80 Bond Street"), 
-                (lambda ID, start: "Must register between 8:00-8:30 AM. Placement begins at 8:30 AM.")),
-        "ST": ("Study Time", 
-                (lambda ID, start: ""), 
-                (lambda ID, start: "")),
-        "ORL": ("Orthodontics Lab", 
-                (lambda ID, start: "Senior Lab"), 
-                (lambda ID, start: "")),
-        "PS": ("Periodontic Suturing", 
-                (lambda ID, start: "Lab 4"), 
-                (lambda ID, start: "Reminder - Bring a banana to suture")),
-        "PSC": ("Pediatric Surgicentre", 
-                (lambda ID, start: "Adult Anaesthesia Clinic - Room 256"), 
-                (lambda ID, start: "")),
-        "CC": ("Restorative CAD/CAM Crowns", 
-                (lambda ID, start: "Clinic 2"), 
-                (lambda ID, start: "")),
-        "ENM": ("Endodontics of Molar", 
-                (lambda ID, start: "Clinic 1"), 
-                (lambda ID, start: "")),
-        "R/1": ("Restorative Test 1 - Practice", 
-                (lambda ID, start: "Clinic 2"), 
-                (lambda ID, start: "")),
-        "R/2": ("Restorative Test 2 - Intracoronal", 
-                (lambda ID, start: "Clinic 2"), 
-                (lambda ID, start: "")),
-        "R/3": ("Restorative Test 3 - Crown", 
-                (lambda ID, start: "Clinic 2"), 
-                (lambda ID, start: "")),
-        "R/4": ("Restorative Test 4 - Anterior Resin", 
-                (lambda ID, start: "Clinic 2"), 
-                (lambda ID, start: "")),
-        "AN3": ("Anaesthesia Clinic (Nitrous Oxide)", 
-                (lambda ID, start: "Clinic 1"), 
-                (lambda ID, start: "")),
-        "IP": ("IPE - Pain", 
-                (lambda ID, start: "External Placements - See Schedule from IPE Co-ordinator"), 
-                (lambda ID, start: "")),
-        "LT": ("IPE - Lindberg Homburger Modent Dental Studies Ltd.", 
-                (lambda ID, start: "1407 Dufferin Street, Toronto, ON  M6H 4C7"), 
-                (lambda ID, start: "")),
-        "TPS": ("IPE - Toronto Paramedic Services", 
-                (lambda ID, start: "4330 Dufferin St, North York, ON M3H 5R9"), 
-                (lambda ID, start: "")),
-        "PB": ("Patient Based Learning Seminar", 
-                (lambda ID, start: "See Course Syllabus"), # TODO: Generate per student
-                (lambda ID, start: "")),
-        "P/F": ("Prosthodontics - Fixed Prostho Seminar", 
-                (lambda ID, start: "See Course Syllabus"), # TODO
-                (lambda ID, start: "")),
-        "P1": ("Preventative Seminar #1", 
-                (lambda ID, start: "See Course Syllabus"), # TODO
-                (lambda ID, start: "")),
-        "P2": ("Preventative Seminar #2", 
-                (lambda ID, start: "See Course Syllabus"), # TODO
-                (lambda ID, start: "")),
-        "ORC": ("Oral Reconstruction Clinic",
-                (lambda ID, start: "See Course Syllabus"), # TODO
-                (lambda ID, start: "")),
-        "GB": ("George Brown Health Sciences",
-                (lambda ID, start: "51 Dockside Dr. - (#6 Bus South on Bay St.)"), # TODO
-                (lambda ID, start: "")),
-        "CA": ("CAMH Rotation",
-                (lambda ID, start: "100 Stokes St."),
-                (lambda ID, start: "Begins at 9:15 AM and 1:15 PM")),
-        "SM": ("St. Michael's Hospital Rotation",
-                (lambda ID, start: "80 Bond St."),
-                (lambda ID, start: "Register at 8 AM. Placement begins at 8:30 AM")),
-        "PMH": ("Princess Margaret Hospital Rotation",
-                (lambda ID, start: "610 University Ave"),
-                (lambda ID, start: "Placement from 4:30 PM - 7:30 PM")),
-        "PB": ("Patient Based Learning Seminar", 
-                (lambda ID, start: "Online - Synchronous"), 
-                (lambda ID, start: "")),
-        "ET": ("Ethics Seminar", 
-                (lambda ID, start: "Online - Synchronous"), 
-                (lambda ID, start: "")),
-        "RS": ("Radiology Seminar", 
-                (lambda ID, start: "Online - Synchronous"), 
-                (lambda ID, start: "")),
-        "AN4": ("Anaesthesia Seminar", 
-                (lambda ID, start: "Online - Synchronous, Room 360"), 
-                (lambda ID, start: "")),
-        "ORS": ("Orthodontics Seminar", 
-                (lambda ID, start: "Online - Synchronous"), 
-                (lambda ID, start: "")),
-        "OX": ("Orthodontics Oral Exam", 
-                (lambda ID, start: "Online - Synchronous"), 
-                (lambda ID, start: "")),
-        "CHS": ("Pediatric Clinic Seminar", 
-                (lambda ID, start: "Online - Synchronous"), 
-                (lambda ID, start: "")),
-        "MS": ("Mount Sinai Rotation", 
-                (lambda ID, start: "600 University Ave - 4th floor"), 
-                (lambda ID, start: "")),
-        "AG": ("AGP", 
-                (lambda ID, start: "Closed Operatory"), 
-                (lambda ID, start: "")),
-        "AG-A": ("AGP Assisting", 
-                (lambda ID, start: "Closed Operatory"), 
-                (lambda ID, start: "")),
-        "IPE": ("Grad Oral Surgery IPE", 
-                (lambda ID, start: "Oral Surgery Clinic - 1st floor"), 
-                (lambda ID, start: "Arrive by 8:45 AM" if start.time() >= time(12) else "Arrive by 12:45 PM"))
-    }
-    
-    CLINIC_COLOUR_KEY = {
-        "FT": vText("Lectures"),
-        "C1": vText("Orange Category"),
-        "C2": vText("Orange Category"),
-        "CH": vText("Orange Category"),
-        "EM": vText("Orange Category"),
-        "OD": vText("Orange Category"),
-        "OR": vText("Orange Category"),
-        "RA": vText("Orange Category"),
-        "SC": vText("Orange Category"),
-        "HR": vText("Red Category"),
-        "GB": vText("Red Category"),
-        "CA": vText("Red Category"),
-        "Ge": vText("Red Category"),
-        "Go": vText("Red Category"),
-        "Gp": vText("Red Category"),
-        "Gpr": vText("Red Category"),
-        "SM": vText("Red Category"),
-        "ST": vText("Green Category"),
-        "ORL": vText("Purple Category"),
-        "PS": vText("Purple Category"),
-        "PSC": vText("Red Category"),
-        "CC": vText("Red Category"),
-        "ENM": vText("Purple Category"),
-        "R/1": vText("Blue Category"),
-        "R/2": vText("Blue Category"),
-        "R/3": vText("Blue Category"),
-        "R/4": vText("Blue Category"),
-        "AN3": vText("Orange Category"),
-        "IP": vText("Red Category"),
-        "LT": vText("Red Category"),
-        "TPS": vText("Red Category"),
-        "PB": vText("Purple Category"),
-        "P/F": vText("Purple Category"),
-        "P1": vText("Purple Category"),
-        "P2": vText("Purple Category"),
-        "ORC": vText("Red Category"),
-        "GB": vText("Red Category"),
-        "CA": vText("Red Category"),
-        "SM": vText("Red Category"),
-        "PMH": vText("Red Category"),
-        "PB": vText("Purple Category"),
-        "ET": vText("Purple Category"),
-        "RS": vText("Purple Category"),
-        "AN4": vText("Purple Category"),
-        "ORS": vText("Purple Category"),
-        "OX": vText("Blue Category"),
-        "CHS": vText("Purple Category"),
-        "MS": vText("Red Category"),
-        "AG": vText("Red Category"),
-        "AG-A": vText("Red Category"),
-        "IPE": vText("Red Category")
-    }
-    
-    def __init__(self, clinic, room, description, start, end, colour):
+    def __init__(self, clinic, room, description, start, end, colour, slot=None):
         self.clinic = clinic
         self.room = room
         self.description = description
         self.start = start
         self.end = end
         self.colour = colour
+        self.slot = slot
 
     @staticmethod
-    def createSession(clinicKey, studentClinicID, start, end):
+    def createSession(clinicKey, studentClinicID, start, end, catalogue=None,
+                      dstTable=EASTERN_DST, slot=None, seminarRooms=None):
         """Helper method to create a Session class
         
         clinicKey (str)
             A string key used to determine which clinic the key refers to
         studentClinicID (int)
             Student clinical number
-        start (datetime)
-            When the session starts
-        end (datetime)
-            When the session ends
+        start (int)
+            When the session starts, in epoch minutes
+        end (int)
+            When the session ends, in epoch minutes
+        catalogue (ClinicCatalogue) [ClinicCatalogue.default()]
+            What the clinic keys mean
+        dstTable (DSTTable) [EASTERN_DST]
+            Transition table of the desired timezone
+        slot (str) [None]
+            Which session of the day it is, see Session
+        seminarRooms (SeminarRooms) [None]
+            Students' own rooms, replacing the catalogue's
         returns Session
             Contains everything you need to know about a clinic timeslot
         """
         
-        assert start.weekday() >= MONDAY and start.weekday() <= FRIDAY
+        if catalogue is None:
+            catalogue = ClinicCatalogue.default()
+        local = start + dstTable.offsetAt(start)
+        weekday = (local // MINUTES_PER_DAY + EPOCH_WEEKDAY) % 7
+        assert weekday >= MONDAY and weekday <= FRIDAY
         
-        if clinicKey in Session.CLINIC_KEY:
-            summary, roomFunc, descFunc = Session.CLINIC_KEY[clinicKey]
-            colour = Session.CLINIC_COLOUR_KEY[clinicKey]
-        else:
-            summary = clinicKey
-            roomFunc = lambda ID, start: ""
-            descFunc = lambda ID, start: ""
-            colour = vText("")
-        room = roomFunc(studentClinicID, start)
-        desc = descFunc(studentClinicID, start)
-        return Session(summary, room, desc, start, end, colour)
-
-def createDatetime(excelDataframe, excelRow, studentClinicID, clinicKey, timezone=EASTERN):
+        summary, room, desc, colour = catalogue.lookup(clinicKey, weekday,
+            local % MINUTES_PER_DAY >= 12 * 60)
+        if seminarRooms is not None:
+            room, desc = seminarRooms.lookup(studentClinicID, clinicKey,
+                                             local // MINUTES_PER_DAY, room, desc)
+        return Session(summary, room, desc, start, end, colour, slot)
+
+def createDatetime(excelDataframe, excelRow, studentClinicID, clinicKey, dstTable=EASTERN_DST):
     """Given a row from the clinical Excel file, provide the start and end of
     that session.
     
@@ -916,11 +1004,11 @@ def createDatetime(excelDataframe, excelRow, studentClinicID, clinicKey, timezon
         ID of the student (now that since Mon/Thurs students have wildly
         different times than Tues/Fri students)
     clinicKey (str)
-        ID of clinical session (see Session.CLINIC_KEY)
-    timezone (datetime.tzinfo) [EASTERN]
-        The desired timezone
-    return (datetime, datetime)
-        The start and end times of the session
+        ID of clinical session (see ClinicCatalogue)
+    dstTable (DSTTable) [EASTERN_DST]
+        Transition table of the desired timezone
+    return (int, int)
+        The start and end times of the session in epoch minutes
     """
     
     # Excel file is indexed as follows (assume that we start on a Monday):
@@ -958,74 +1046,550 @@ def createDatetime(excelDataframe, excelRow, studentClinicID, clinicKey, timezon
     
     # Extract time data
     startHour, startMinute = getStartTime(month, day, time, weekday, studentClinicID, clinicKey)
-    start = timezone.localize(datetime(year, month, day, startHour, startMinute, 0))
+    start = localToEpochMinutes(year, month, day, startHour, startMinute, dstTable)
     endHour, endMinute = getEndTime(month, day, time, weekday, studentClinicID, clinicKey)
-    end = timezone.localize(datetime(year, month, day, endHour, endMinute, 0))
+    end = localToEpochMinutes(year, month, day, endHour, endMinute, dstTable)
     return (start, end)
 
-def standardizeDatetime(dateTime, timezone=EASTERN):
+def standardizeDatetime(dateTime, dstTable=EASTERN_DST):
     """To get the datetime objects from the calendar file to comply with my
     manually set up ones.
     
     dateTime (datetime)
         The calendar's datetime
-    timezone (datetime.tzinfo) [EASTERN]
-        The desired timezone
-    returns (datetime)
-        A proper datetime
+    dstTable (DSTTable) [EASTERN_DST]
+        Transition table of the desired timezone
+    returns (int)
+        Its wall-clock time read in the desired timezone, in epoch minutes
     """
-    year = dateTime.year
-    month = dateTime.month
-    day = dateTime.day
-    hour = dateTime.hour
-    minute = dateTime.minute
-    second = dateTime.second
-    return timezone.localize(datetime(year, month, day, hour, minute, second))
-    
-def fixDatetime(dateTime, numWeeks, timezone=EASTERN):
-    """Advances the provided datetime 'numWeeks' ahead, accounting for daylight
-    saving time.
+    return localToEpochMinutes(dateTime.year, dateTime.month, dateTime.day,
+                               dateTime.hour, dateTime.minute, dstTable)
+
+def datetimeToEpochMinutes(dateTime, dstTable=EASTERN_DST):
+    """Converts a datetime from the calendar file into epoch minutes, keeping
+    its own timezone if it has one.
     
     dateTime (datetime)
-        Provided datetime to advance
-    numWeeks (int)
-        Number of weeks to advance
-    timezone (datetime.tzinfo) [EASTERN]
-        The desired timezone
-    returns (datetime)
-        The advanced datetime
+        The calendar's datetime
+    dstTable (DSTTable) [EASTERN_DST]
+        Transition table used for naive datetimes
+    returns (int)
+        Epoch minutes
+    """
+    if dateTime.tzinfo is None:
+        return standardizeDatetime(dateTime, dstTable)
+    return int(dateTime.timestamp()) // 60
+
+class StageTimer:
+    """Records how long each stage of a run takes.
+    
+    Members:
+        stages (list(tuple(str, float)))
+            (Stage name, seconds taken) in the order the stages ran
     """
     
-    # See if given datetime is in DST
-    wasDST = dateTime.dst() != timedelta(0)
+    def __init__(self):
+        self.stages = []
+    
+    @contextmanager
+    def stage(self, name):
+        """Context manager timing the enclosed block as stage 'name'"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, perf_counter() - start))
     
-    # If after advancing by 'numWeeks', we've now changed timezones
-    tempDT = dateTime + timedelta(weeks=numWeeks)
-    if (timezone.normalize(tempDT).dst() != timedelta(0)) ^ wasDST:
-        if wasDST:  # Was DST, now is Standard Time
-            tempDT += dateTime.dst()
-        else:       # Was STD, now DST
-            tempDT -= timezone.normalize(tempDT).dst()
+    def report(self, handle=sys.stderr):
+        """Writes a small table of stage timings to 'handle'"""
+        for (name, seconds) in self.stages:
+            handle.write("{:<12} {:8.3f} s\n".format(name, seconds))
+        if self.stages and self.stages[0][0] == "startup" \
+                and self.stages[0][1] > STARTUP_BUDGET:
+            handle.write("warning: startup took {:.3f} s, over the {:.3f} s budget\n"
+                         "".format(self.stages[0][1], STARTUP_BUDGET))
+
+def writeAtomic(path, data):
+    """Writes 'data' to 'path' so that readers only ever see the old file or
+    the complete new one: the bytes go to a temporary file in the same
+    directory which is then renamed over the target.
     
-    return timezone.normalize(tempDT)
+    path (str)
+        File to write
+    data (bytes)
+        Contents
+    """
+    directory, name = os.path.split(path)
+    tempPath = os.path.join(directory, ".{}.{}.tmp".format(name, os.getpid()))
+    try:
+        with open(tempPath, "wb") as output:
+            output.write(data)
+        os.replace(tempPath, path)
+    except BaseException:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
 
-def main(args):
-    clinicFile = args.clinicFile
-    calendarFile = args.calendarFile
-    outputDir = args.outputDir
-    mode = args.mode
-    startStudentID = int(args.start)
-    endStudentID = int(args.end)
+class RunMetrics(StageTimer):
+    """A StageTimer that also counts what a run produced, so that scheduled
+    runs can be logged as JSON lines and scraped by Prometheus (through the
+    node exporter's textfile collector) and graphed over time.
+    
+    Members:
+        counters (dict(str: int))
+            Totals by name, see count()
+        eventsPerStudent (list(int))
+            Number of events in each calendar generated in full
+        unknownClinicKeys (dict(str: int))
+            Clinic keys missing from the catalogue and how many sessions had
+            them
+        uncategorizedSummaries (set(str))
+            Summaries no category rule matched, in any faculty calendar
+        error (str or None)
+            What went wrong, if the run failed
+    """
+    
+    # Prefix of every Prometheus metric
+    PROMETHEUS_PREFIX = "dental_calendar_"
+    
+    def __init__(self):
+        super().__init__()
+        self.counters = {}
+        self.eventsPerStudent = []
+        self.unknownClinicKeys = {}
+        self.uncategorizedSummaries = set()
+        self.error = None
+    
+    def count(self, name, amount=1):
+        """Adds 'amount' to counter 'name'"""
+        self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def calendar(self, data):
+        """Records a calendar generated in full (bytes)"""
+        events = data.count(b"BEGIN:VEVENT")
+        self.eventsPerStudent.append(events)
+        self.count("events", events)
+        self.count("outputBytes", len(data))
+    
+    def update(self, other):
+        """Adds in the metrics of another part of the run (e.g. a worker
+        process)"""
+        self.stages.extend(other.stages)
+        for (name, amount) in other.counters.items():
+            self.count(name, amount)
+        self.eventsPerStudent.extend(other.eventsPerStudent)
+        for (clinicKey, amount) in other.unknownClinicKeys.items():
+            self.unknownClinicKeys[clinicKey] = \
+                self.unknownClinicKeys.get(clinicKey, 0) + amount
+        self.uncategorizedSummaries |= other.uncategorizedSummaries
+    
+    def summary(self):
+        """Everything recorded, as a JSON-ready dict"""
+        stages = {}
+        for (name, seconds) in self.stages:
+            stages[name] = stages.get(name, 0.0) + seconds
+        events = self.eventsPerStudent
+        # Faculty calendars share most summaries, so they are counted once
+        counters = dict(self.counters,
+                        uncategorizedSummaries=len(self.uncategorizedSummaries))
+        return {
+            "time": datetime.now(EASTERN).isoformat(timespec="seconds"),
+            "status": "ok" if self.error is None else "error",
+            "error": self.error,
+            "seconds": perf_counter() - _MODULE_START,
+            "stages": stages,
+            "counters": dict(sorted(counters.items())),
+            "eventsPerStudent": {
+                "min": min(events) if events else 0,
+                "mean": sum(events) / len(events) if events else 0,
+                "max": max(events) if events else 0
+            },
+            "unknownClinicKeys": dict(sorted(self.unknownClinicKeys.items())),
+            "uncategorizedSummaries": sorted(self.uncategorizedSummaries)
+        }
+    
+    def writeJSONLines(self, path):
+        """Appends the summary of this run to a JSON lines log"""
+        with open(path, "a") as handle:
+            handle.write(json.dumps(self.summary()) + "\n")
+    
+    def writePrometheus(self, path):
+        """Writes the summary in the Prometheus text format, replacing the
+        file atomically so the collector never reads half of it"""
+        summary = self.summary()
+        lines = []
+        def metric(name, description, samples):
+            name = RunMetrics.PROMETHEUS_PREFIX + name
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} gauge".format(name))
+            for (labels, value) in samples:
+                labelText = ",".join('{}="{}"'.format(label, str(text).replace("\\", "\\\\")
+                                                                      .replace('"', '\\"'))
+                                     for (label, text) in labels)
+                lines.append("{}{} {}".format(name, "{" + labelText + "}" if labels else "",
+                                              float(value)))
+        
+        metric("last_run_timestamp_seconds", "When the last run finished",
+               [((), datetime.now().timestamp())])
+        metric("last_run_success", "Whether the last run succeeded",
+               [((), summary["status"] == "ok")])
+        metric("run_seconds", "How long the last run took",
+               [((), summary["seconds"])])
+        metric("stage_seconds", "How long each stage of the last run took",
+               [((("stage", name),), seconds)
+                for (name, seconds) in summary["stages"].items()])
+        metric("counter", "Totals of the last run",
+               [((("name", name),), amount)
+                for (name, amount) in summary["counters"].items()])
+        metric("events_per_student", "Events per calendar generated in full",
+               [((("stat", stat),), value)
+                for (stat, value) in summary["eventsPerStudent"].items()])
+        metric("unknown_clinic_key_sessions", "Sessions with a key missing from "
+               "the clinic catalogue", [((("key", key),), amount)
+                                        for (key, amount) in summary["unknownClinicKeys"].items()])
+        writeAtomic(path, ("\n".join(lines) + "\n").encode())
+
+class CalendarWriter:
+    """Serializes and writes calendars on a bounded pool of threads so that
+    building the next student's calendar overlaps with writing the last one,
+    which matters on network drives where the writes dominate.
+    
+    Members:
+        outputDir (str)
+            Directory the calendars are written to
+        maxWorkers (int)
+            Number of writer threads; 0 writes synchronously
+    
+    Use as a context manager, or call close() to wait for outstanding writes.
+    Errors raised by a write are re-raised from close().
+    """
+    
+    def __init__(self, outputDir, maxWorkers=4):
+        self.outputDir = outputDir
+        self.maxWorkers = maxWorkers
+        self._futures = []
+        if maxWorkers > 0:
+            from concurrent.futures import ThreadPoolExecutor
+            from threading import BoundedSemaphore
+            self._pool = ThreadPoolExecutor(maxWorkers)
+            # At most two calendars per thread are held in memory at once
+            self._slots = BoundedSemaphore(2 * maxWorkers)
+        else:
+            self._pool = None
+        
+        if not os.path.exists(outputDir):
+            os.mkdir(outputDir)
+    
+    def _store(self, fileName, data):
+        """Puts one serialized calendar where it belongs"""
+        writeAtomic(os.path.join(self.outputDir, fileName), data)
+    
+    def _storeIndexed(self, fileName, data, index):
+        """Puts a calendar and its .idx sidecar (see indexCalendar) in place"""
+        self._store(fileName, data)
+        sourceDigest, entries = index
+        self._store(fileName + ".idx",
+                    json.dumps(indexCalendar(data, entries, sourceDigest)).encode())
+    
+    def _write(self, fileName, serialize, index, done=None):
+        try:
+            if index is None:
+                self._store(fileName, serialize())
+            else:
+                self._storeIndexed(fileName, serialize(), index)
+            if done is not None:
+                done()
+        finally:
+            if self._pool is not None:
+                self._slots.release()
+    
+    def _queue(self, fileName, serialize, index=None, done=None):
+        if self._pool is None:
+            self._write(fileName, serialize, index, done)
+            return
+        self._slots.acquire()
+        self._futures.append(self._pool.submit(self._write, fileName, serialize, index,
+                                               done))
+    
+    def write(self, fileName, calendar, index=None):
+        """Queues 'calendar' to be written to 'fileName' in outputDir
+        
+        index (tuple(str, list(tuple(str, str)))) [None]
+            (Source digest, (UID, fingerprint) of each event) to also write a
+            .idx sidecar that lets later runs patch the calendar
+        """
+        self._queue(fileName, calendar.to_ical, index)
+    
+    def writeData(self, fileName, data, index=None, done=None):
+        """Queues already serialized 'data' to be written to 'fileName', with
+        a .idx sidecar if 'index' is given (see write()), calling done() once
+        it is written"""
+        self._queue(fileName, lambda: data, index, done)
+    
+    def writeExport(self, fileName, header, records, exportFormat, done=None):
+        """Queues a JSON export to be encoded (see encodeExport()) and written
+        to 'fileName', calling done() once it is written"""
+        self._queue(fileName, lambda: encodeExport(header, records, exportFormat),
+                    done=done)
+    
+    def close(self):
+        """Waits for all queued writes, re-raising the first failure"""
+        if self._pool is None:
+            return
+        self._pool.shutdown(wait=True)
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+# Archive formats understood by ArchiveWriter, by file extension
+ARCHIVE_FORMATS = {
+    ".zip": "zip",
+    ".tar.gz": "tar",
+    ".tgz": "tar"
+}
+
+class ArchiveWriter(CalendarWriter):
+    """Streams every calendar straight into a single zip or tar.gz archive
+    instead of writing one file each. The archive is built under a temporary
+    name and renamed into place by close(), so it is written in one pass and
+    never seen half-finished.
+    
+    Members:
+        archivePath (str)
+            The .zip, .tar.gz or .tgz file to create
+        compressionLevel (int)
+            zlib compression level, 0 (none) to 9 (smallest)
+    """
+    
+    def __init__(self, archivePath, compressionLevel=6):
+        self.archivePath = archivePath
+        self.compressionLevel = compressionLevel
+        self._format = archiveFormat(archivePath)
+        self._mtime = datetime.now()
+        directory, name = os.path.split(archivePath)
+        self._tempPath = os.path.join(directory, ".{}.{}.tmp".format(name, os.getpid()))
+        
+        # Members have to be appended one after the other, so a single thread
+        # does the serializing and compressing while generation carries on
+        CalendarWriter.__init__(self, directory or os.curdir, 1)
+        if self._format == "zip":
+            import zipfile
+            self._archive = zipfile.ZipFile(self._tempPath, "w", zipfile.ZIP_DEFLATED,
+                                            compresslevel=compressionLevel)
+        else:
+            import tarfile
+            self._archive = tarfile.open(self._tempPath, "w:gz",
+                                         compresslevel=compressionLevel)
+    
+    def _store(self, fileName, data):
+        if self._format == "zip":
+            import zipfile
+            info = zipfile.ZipInfo(fileName, self._mtime.timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self._archive.writestr(info, data, compresslevel=self.compressionLevel)
+        else:
+            import io
+            import tarfile
+            info = tarfile.TarInfo(fileName)
+            info.size = len(data)
+            info.mtime = self._mtime.timestamp()
+            self._archive.addfile(info, io.BytesIO(data))
+    
+    def close(self):
+        """Waits for all queued calendars and finishes the archive"""
+        try:
+            CalendarWriter.close(self)
+        except BaseException:
+            self._discard()
+            raise
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+            os.replace(self._tempPath, self.archivePath)
+    
+    def _discard(self):
+        """Abandons the archive, leaving any previous one untouched"""
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+            os.remove(self._tempPath)
+    
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            try:
+                CalendarWriter.close(self)
+            finally:
+                self._discard()
+
+def archiveFormat(archivePath):
+    """Returns the ARCHIVE_FORMATS entry for 'archivePath', or None"""
+    for (extension, archiveType) in ARCHIVE_FORMATS.items():
+        if archivePath.lower().endswith(extension):
+            return archiveType
+    return None
+
+# Version of the JSON export layout, bumped whenever a field changes meaning
+# or goes away. Each export is an object
+#     {"schema": 1, "student": 5, "calendar": "... 1-30.ics", "source": digest,
+#      "timezone": "Canada/Eastern", "events": [event, ...]}
+# (JSON lines: the same object without "events" on the first line, then an
+# event per line), and each event is
+#     {"uid", "summary", "start", "end", "allDay", "location", "description",
+#      "category", "personalized"}
+# with times formatted by exportTime(). Recurring events have a record per
+# occurrence, all with the same UID
+EXPORT_SCHEMA = 1
+
+# Export formats by file extension: (JSON lines?, compression)
+EXPORT_FORMATS = {
+    ".json": (False, None),
+    ".jsonl": (True, None),
+    ".json.gz": (False, "gzip"),
+    ".jsonl.gz": (True, "gzip"),
+    ".json.br": (False, "brotli"),
+    ".jsonl.br": (True, "brotli")
+}
+
+def encodeExport(header, records, exportFormat):
+    """Serializes (and compresses) one JSON export
+    
+    header (dict)
+        Everything but the events, see EXPORT_SCHEMA
+    records (list(dict))
+        The events, see StudentEvent.records()
+    exportFormat (str)
+        An EXPORT_FORMATS extension
+    returns (bytes)
+    """
+    lines, compression = EXPORT_FORMATS[exportFormat]
+    header = dict({"schema": EXPORT_SCHEMA}, **header)
+    if lines:
+        text = "\n".join(json.dumps(item, separators=(",", ":"))
+                         for item in chain([header], records)) + "\n"
+    else:
+        header["events"] = records
+        text = json.dumps(header, separators=(",", ":"))
+    data = text.encode()
+    if compression == "gzip":
+        import gzip
+        return gzip.compress(data, mtime=0)
+    if compression == "brotli":
+        import brotli
+        return brotli.compress(data)
+    return data
+
+def readCalendar(calendarFile, raw=False):
+    """Parses the faculty calendar
+    
+    calendarFile (str)
+        Microsoft Calendar .ics file containing class schedule
+    raw (bool) [False]
+        Also return its events as they are in the file
+    returns (icalendar.Calendar, list(icalendar.cal.Component))
+        The calendar and all of its components, plus its events (see
+        splitRawEvents()) if 'raw'
+    """
+    from icalendar import Calendar
     
-    # Go through calendar, gathering events
     with open(calendarFile, "rb") as calendarHandle:
-        cal = Calendar.from_ical(calendarHandle.read())
-        components = list(cal.walk())
+        data = calendarHandle.read()
+    cal = Calendar.from_ical(data)
+    components = list(cal.walk())
+    if raw:
+        return (cal, components, splitRawEvents(data))
+    return (cal, components)
+
+# Event properties kept by --passthrough unless --keep adds more: the ones
+# of RFC 5545. Outlook's own (X-ALT-DESC with the HTML description,
+# X-MICROSOFT-CDO-*) and alarms (VALARM) have to be asked for
+PASSTHROUGH_PROPERTIES = frozenset([
+    "ATTACH", "ATTENDEE", "CATEGORIES", "CLASS", "COMMENT", "CONTACT", "CREATED",
+    "DESCRIPTION", "DTEND", "DTSTAMP", "DTSTART", "DURATION", "EXDATE", "GEO",
+    "LAST-MODIFIED", "LOCATION", "ORGANIZER", "PRIORITY", "RDATE", "RECURRENCE-ID",
+    "RELATED-TO", "RESOURCES", "RRULE", "RSTATUS", "SEQUENCE", "STATUS", "SUMMARY",
+    "TRANSP", "UID", "URL"
+])
+
+def splitRawEvents(data):
+    """The top-level VEVENTs of a calendar file as they are, in order
+    
+    data (bytes)
+        The calendar file
+    returns (list(bytes))
+    """
+    return re.findall(rb"^BEGIN:VEVENT\r?\n.*?^END:VEVENT(?:\r?\n|$)", data,
+                      re.MULTILINE | re.DOTALL)
+
+def passthroughEvent(raw, allowed=PASSTHROUGH_PROPERTIES, category=None):
+    """Copies a raw event content line by content line, keeping the allowed
+    properties and subcomponents byte for byte (folding included) instead of
+    decoding and re-encoding them, numbered 0 and split around its UID line
+    (see splitAtUID())
+    
+    raw (bytes)
+        The event, see splitRawEvents()
+    allowed (set(str)) [PASSTHROUGH_PROPERTIES]
+        Upper case names of the properties and subcomponents (e.g. "VALARM")
+        to keep; everything else is dropped
+    category (str) [None]
+        Category replacing the event's own, if it has one
+    returns (bytes, bytes or None)
+    """
+    from icalendar.prop import vText
+    
+    before = []
+    after = None
+    kept = before
+    skipping = None # Name of the subcomponent being dropped
+    depth = 0 # How deep in subcomponents that are kept
+    for line in re.split(rb"\r?\n(?![ \t])", raw):
+        if not line:
+            continue
+        name = re.match(rb"[^:;]*", line).group().decode("ascii", "replace").upper()
+        value = line.split(b":", 1)[-1].decode("ascii", "replace").strip().upper()
+        if skipping is not None:
+            if name == "END" and value == skipping:
+                skipping = None
+            continue
+        if name == "BEGIN" and value != "VEVENT":
+            if depth == 0 and value not in allowed:
+                skipping = value
+                continue
+            depth += 1
+        elif name == "END" and value != "VEVENT":
+            depth -= 1
+        elif depth > 0 or name in ("BEGIN", "END"):
+            pass
+        elif name == "UID":
+            after = []
+            kept = after
+            continue
+        elif name == "CATEGORIES" and category is not None:
+            line = b"CATEGORIES:" + vText(category).to_ical()
+        elif name not in allowed:
+            continue
+        kept.append(line + b"\r\n")
     
-    # Go through clinical schedule, gathering which clinics people are in at
-    # whatever dates and times
-    clinics = read_excel(clinicFile, sheet_name=0)
+    if after is None:
+        return (b"".join(before), None)
+    return (b"".join(before), b"".join(after))
+
+def clinicLayout():
+    """Where the clinical sessions are in the 2020-2021 clinic Excel file,
+    which has to be figured out by hand
     
+    returns (list(int), list(str))
+        The dataframe row of every session in order, and the dataframe column
+        of every student (index 0 is student 1)
+    """
     # Magic sequence that indicates the start of each session
     startOfWeeks = []
     # For Sept to Dec
@@ -1065,148 +1629,2353 @@ def main(args):
                      + ["Section.5"] \
                      + ["Unnamed: {}".format(i) for i in range(107,126)]
     
+    return (sessions, clinicNumberCols)
+
+def loadLayout(layoutFile):
+    """Reads the layout of a clinic Excel file other than 2020-2021's
+    
+    layoutFile (str)
+        JSON object with "rows" (dataframe row of every session in order) and
+        "columns" (dataframe column of every student, starting at student 1)
+        of the first sheet. Sessions spread over several sheets or workbooks
+        are given as "sheets" instead, a list of objects with "sheet" (name
+        or 0-based index), its "rows" and optionally its own "columns",
+        "workbook" (relative to the layout file; the clinic Excel file if
+        left out) and "firstStudent" (clinic ID of its first column, 1 if
+        left out)
+    returns (list(int), list(str)) or list(tuple)
+        See clinicLayout(), or the sheets as in layoutSheets()
+    """
+    with open(layoutFile) as handle:
+        layout = json.load(handle)
+    if "sheets" not in layout:
+        return (layout["rows"], layout["columns"])
+    folder = os.path.dirname(os.path.abspath(layoutFile))
+    return [(None if "workbook" not in sheet else os.path.join(folder, sheet["workbook"]),
+             sheet["sheet"], sheet["rows"], sheet.get("columns", layout.get("columns")),
+             sheet.get("firstStudent", 1))
+            for sheet in layout["sheets"]]
+
+def layoutSheets(clinicFile, layout=None):
+    """Every sheet a layout has sessions in
+    
+    clinicFile (str)
+        Excel file containing clinic data
+    layout [clinicLayout()]
+        See loadLayout()
+    returns (list(tuple(str, str or int, list(int), list(str), int)))
+        (Workbook, sheet, dataframe rows, dataframe columns, clinic ID of the
+        first column) of each
+    """
+    if layout is None:
+        layout = clinicLayout()
+    if isinstance(layout, tuple):
+        sessions, clinicNumberCols = layout
+        return [(clinicFile, 0, sessions, clinicNumberCols, 1)]
+    return [(clinicFile if workbook is None else workbook, sheet, sessions,
+             clinicNumberCols, firstStudent)
+            for (workbook, sheet, sessions, clinicNumberCols, firstStudent) in layout]
+
+def layoutStudents(layout=None):
+    """Clinic IDs of every student in a layout (see loadLayout()), sorted"""
+    return sorted({firstStudent + i
+                   for (_, _, _, clinicNumberCols, firstStudent) in layoutSheets(None, layout)
+                   for i in range(len(clinicNumberCols))})
+
+def readClinicSheet(clinicFile, sheet, sessions, clinicNumberCols, firstStudent, students,
+                    catalogue=None, eventFilter=None, seminarRooms=None):
+    """Reads the sessions of one sheet of the clinical schedule, loading only
+    the columns of the students wanted and the rows up to the last session
+    
+    clinicFile (str)
+        Excel file containing clinic data
+    sheet (str or int)
+        Name or 0-based index of the sheet
+    sessions (list(int))
+        Dataframe row of every session
+    clinicNumberCols (list(str))
+        Dataframe column of every student in the sheet
+    firstStudent (int)
+        Clinic ID of the student in the first column
+    students (iterable(int))
+        Which student clinic IDs to read; those not in the sheet are ignored
+    catalogue, eventFilter, seminarRooms
+        See readClinicData()
+    returns (dict(int: dict(int: Session)))
+        See readClinicData()
+    """
+    from pandas import read_excel
+    
+    if catalogue is None:
+        catalogue = ClinicCatalogue.default()
+    columns = {studentClinicID: clinicNumberCols[studentClinicID - firstStudent]
+               for studentClinicID in students
+               if 0 <= studentClinicID - firstStudent < len(clinicNumberCols)}
+    if not columns or not sessions:
+        return {}
+    
+    # Day, Date and Time come first, see createDatetime()
+    usecols = ["Unnamed: 0", "Unnamed: 1", "Unnamed: 2"]
+    usecols += sorted(set(columns.values()) - set(usecols))
+    clinics = read_excel(clinicFile, sheet_name=sheet, usecols=usecols,
+                         nrows=max(sessions) + 1)
+    
+    if eventFilter is not None:
+        sessions = [sess for sess in sessions
+                    if eventFilter.keepsDay(clinics.at[sess, "Unnamed: 1"])]
+    
+    # Which session of the day each row is, with Friday's PM named like the rest
+    slots = {sess: "PM1" if clinics.at[sess, "Unnamed: 2"] == "PM"
+                   else clinics.at[sess, "Unnamed: 2"] for sess in sessions}
+    
     # Now to finally parse the Excel file and extract which clinic should
     # someone be at what time
-    clinicData = []
-    for (studentClinicID, col) in enumerate(clinicNumberCols):
-        studentClinicID += 1 # Make it indexed starting at 1
-        clinicData.append(dict())
+    clinicData = {}
+    for (studentClinicID, col) in columns.items():
+        clinicData[studentClinicID] = dict()
         for sess in sessions:
             clinicKey = str(clinics.at[sess, col])
             start, end = createDatetime(clinics, sess, studentClinicID, clinicKey)
-            newSession = Session.createSession(clinicKey, studentClinicID, start, end)
-            clinicData[studentClinicID-1][start] = newSession
+            if eventFilter is not None and not eventFilter.keepsSession(
+                    clinicKey, catalogue.colours.get(clinicKey, "")):
+                clinicData[studentClinicID][start] = None
+                continue
+            newSession = Session.createSession(clinicKey, studentClinicID, start, end,
+                                               catalogue, slot=slots[sess],
+                                               seminarRooms=seminarRooms)
+            clinicData[studentClinicID][start] = newSession
+    return clinicData
+
+def readClinicSheetAlone(*sheetArgs):
+    """readClinicSheet() in a process of its own
+    
+    returns (dict, dict(str: int), tuple(set(tuple), set(tuple)))
+        Its sessions, plus the clinic keys it found missing from the catalogue
+        and the seminar rooms it used and superseded, to add to the parent
+        process's
+    """
+    catalogue, seminarRooms = sheetArgs[6], sheetArgs[8]
+    if catalogue is not None:
+        catalogue.unknown = {}
+    if seminarRooms is not None:
+        seminarRooms.used = set()
+        seminarRooms.superseded = set()
+    clinicData = readClinicSheet(*sheetArgs)
+    return (clinicData, {} if catalogue is None else catalogue.unknown,
+            (set(), set()) if seminarRooms is None
+            else (seminarRooms.used, seminarRooms.superseded))
 
-    # Create the output directory
-    if not os.path.exists(outputDir):
-        os.mkdir(outputDir)
+def readClinicData(clinicFile, catalogue=None, layout=None, students=None,
+                   eventFilter=None, seminarRooms=None):
+    """Goes through clinical schedule, gathering which clinics people are in at
+    whatever dates and times. Sessions spread over several sheets or workbooks
+    are read in parallel, a process per sheet, and merged
+    
+    clinicFile (str)
+        Excel file containing clinic data
+    catalogue (ClinicCatalogue) [ClinicCatalogue.default()]
+        What the clinic keys mean
+    layout [clinicLayout()]
+        Where the sessions are, see clinicLayout() and loadLayout()
+    students (iterable(int)) [everyone in the layout]
+        Which student clinic IDs to read
+    eventFilter (EventFilter) [None]
+        Which sessions are wanted; days that aren't are skipped, and sessions
+        that aren't are stored as None
+    seminarRooms (SeminarRooms) [None]
+        Students' own rooms for seminars, see readSeminarRooms()
+    returns (dict(int: dict(int: Session)))
+        For each student clinic ID, their sessions keyed by start time in
+        epoch minutes; a later sheet's session replaces an earlier one
+        starting at the same time
+    """
+    if catalogue is None:
+        catalogue = ClinicCatalogue.default()
+    sheets = layoutSheets(clinicFile, layout)
+    everyone = layoutStudents(layout)
+    if students is None:
+        students = everyone
+    students = list(students)
+    known = set(everyone)
+    for studentClinicID in students:
+        if studentClinicID not in known:
+            raise ValueError("Student {} is not in the clinic Excel file, which has "
+                             "students {}-{}".format(studentClinicID, everyone[0],
+                                                     everyone[-1]))
+    
+    # Skip sheets none of the students are in without opening them
+    sheets = [sheet for sheet in sheets
+              if any(0 <= studentClinicID - sheet[4] < len(sheet[3])
+                     for studentClinicID in students)]
+    sheetArgs = [sheet + (students, catalogue, eventFilter, seminarRooms)
+                 for sheet in sheets]
+    workers = min(len(sheets), os.cpu_count() or 1)
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
         
-    # Create a calendar for each student
-    for studentClinicID in range(startStudentID, endStudentID+1): #TODO testing
-        # Skip non-existing students
-        if studentClinicID == 61 or studentClinicID == 120:
-            continue
+        parts = []
+        with ProcessPoolExecutor(workers) as pool:
+            for (part, unknown, used) in pool.map(readClinicSheetAlone, *zip(*sheetArgs)):
+                parts.append(part)
+                for (clinicKey, amount) in unknown.items():
+                    catalogue.unknown[clinicKey] = catalogue.unknown.get(clinicKey, 0) + amount
+                if seminarRooms is not None:
+                    seminarRooms.used |= used[0]
+                    seminarRooms.superseded |= used[1]
+    else:
+        parts = [readClinicSheet(*args) for args in sheetArgs]
     
-        UID_COUNTER = 0
-        newCal = Calendar()
-        newCal.add("prodid", cal.get("prodid"))
-        newCal.add("version", cal.get("version"))
-        for c in components:
-            if c.name == "VEVENT":
-                # Find events that are clinical sessions and update them
-                if "Clinical Practice" in str(c.get("summary")) or "Ancillary Clinics" in str(c.get("summary")):
-                    eStart = standardizeDatetime(c.get("dtstart").dt)
-                    
-                    # These events are programmed to occur every week, skipping
-                    # some when noted. So, create a series of new events for
-                    # each valid week.
-                    try:
-                        repeats = c.get("rrule")["COUNT"][0]
-                    except:
-                        repeats = 1
-                    try:
-                        skips = [dt.dt for dt in c.get("exdate").dts]
-                    except:
-                        skips = []
-                    for r in range(repeats):
-                        # Skip 'r' weeks from the starting point
-                        tempdt = fixDatetime(eStart, r)
-                        
-                        # If this date is to be skipped (holiday, hospital etc.)
-                        if tempdt in skips:
-                            continue
-                        session = clinicData[studentClinicID-1][tempdt]
-                        
-                        # If this is a PM2 session for AGP and the Excel file
-                        # says that it's a study time or faculty time, skip it
-                        if tempdt.hour == 16 and tempdt.minute == 30 \
-                                and (session.clinic == Session.CLINIC_KEY["ST"][0] \
-                                     or session.clinic == Session.CLINIC_KEY["FT"][0]):
-                            continue
-                            
-                        # Create a new event based on this time and add a bunch
-                        # of junk to make the calendar uptake it
-                        event = Event()
-                        event.add("categories", session.colour)
-                        event.add("class", c.get("class"))
-                        event.add("created", c.get("created"))
-                        event.add("dtstart", session.start)
-                        event.add("dtend", session.end)
-                        event.add("dtstamp", c.get("dtstamp"))
-                        event.add("description", session.description)
-                        event.add("last-modified", c.get("last-modified"))
-                        event.add("location", session.room)
-                        event.add("priority", c.get("priority"))
-                        event.add("sequence", c.get("sequence"))
-                        event.add("summary", session.clinic)
-                        event.add("transp", c.get("transp"))
-                        event.add("UID", "{:X}".format(UID + UID_COUNTER))
-                        UID_COUNTER += 1
-                        newCal.add_component(event)
-                else: # Intercept it and change its colour
-                    if mode == "Clinics": # If only clinics are to be outputted
-                        continue
-                        
-                    event = Event()
-                    for k in c.keys():
-                        k = k.lower()
-                        if k == "categories":
-                            summary = str(c.get("summary"))
-                            if summary in NON_CLINIC_COLOUR_KEY.keys():
-                                event.add("categories", NON_CLINIC_COLOUR_KEY[summary])
-                            else:
-                                event.add("categories", c.get("categories"))
-                        elif k == "uid":
-                            event.add("UID", "{:X}".format(UID + UID_COUNTER))
-                            UID_COUNTER += 1
-                        elif k == "x-alt-desc" \
-                                or k == "x-microsoft-cdo-busystatus" \
-                                or k == "x-microsoft-cdo-importance" \
-                                or k == "x-microsoft-disallow-counter":
-                            pass
-                        else:
-                            event.add(k, c.get(k))
-                    newCal.add_component(event)
+    clinicData = {studentClinicID: {} for studentClinicID in students}
+    for part in parts:
+        for (studentClinicID, sessions) in part.items():
+            clinicData[studentClinicID].update(sessions)
+    return clinicData
+
+class SeminarRooms:
+    """Rooms (and details) of seminars that are given per student, where the
+    catalogue can only say e.g. "See Course Syllabus", indexed so that
+    building a session costs a dictionary lookup or two.
+    
+    Members:
+        rooms (dict(tuple(int, str, int or None): tuple(str, str)))
+            (Student clinic ID, clinic key, local date in days since the epoch
+            or None for every date) to (room, details)
+        used (set(tuple))
+            Keys of 'rooms' that some session was given
+        superseded (set(tuple))
+            Keys of 'rooms' without a date that a session had but got the
+            room of a row with its date instead
+    """
+    
+    def __init__(self, rooms):
+        self.rooms = rooms
+        self.used = set()
+        self.superseded = set()
+    
+    def lookup(self, studentClinicID, clinicKey, day, room, description):
+        """The room and description of one session
         
-        # Write calendar to file
-        outputFile = "{}/{} - {}.ics".format(outputDir,
-            calendarFile.split(".",1)[0][:25], studentClinicID)
-        with open(outputFile, "wb") as output:
-            output.write(newCal.to_ical())
+        studentClinicID (int)
+            Which student
+        clinicKey (str)
+            Its clinic key
+        day (int)
+            Its local date in days since the epoch
+        room, description (str)
+            What the catalogue says, kept if the student has no room of
+            their own (or no details)
+        returns (str, str)
+        """
+        key = (studentClinicID, clinicKey, day)
+        assigned = self.rooms.get(key)
+        if assigned is None:
+            key = (studentClinicID, clinicKey, None)
+            assigned = self.rooms.get(key)
+            if assigned is None:
+                return (room, description)
+        elif (studentClinicID, clinicKey, None) in self.rooms:
+            self.superseded.add((studentClinicID, clinicKey, None))
+        self.used.add(key)
+        return (assigned[0], assigned[1] or description)
     
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+    def unused(self, students):
+        """Keys of 'rooms' for these students that no session was given or
+        had, sorted"""
+        return self._sorted(key for key in self.rooms
+                            if key[0] in students and key not in self.used
+                            and key not in self.superseded)
     
-    # Add positional arguments
-    parser.add_argument("clinicFile",
-                        metavar="<clinic.xlsx>",
-                        action=CheckFileAction,
-                        help="""Excel file containing clinic data""")
-    parser.add_argument("calendarFile",
-                        metavar="<calendar.ics>",
-                        action=CheckFileAction,
-                        help="""Microsoft Calendar .ics file containing class
-                            schedule""")
-                            
-    # Add optional arguments
-    parser.add_argument("-o", "--outputDir",
-                        metavar="DIR",
-                        default="Dental Calendars",
-                        help="""Output directory to store new .ics files
-                            [Dental Calendars/]""")
-    parser.add_argument("-s", "--start",
-                        metavar="int",
-                        default=1,
-                        help="""Starting student clinic ID number""")
-    parser.add_argument("-e", "--end",
-                        metavar="int",
-                        default=120,
-                        help="""Ending student clinic ID number""")
-    parser.add_argument("-m", "--mode",
-                        metavar="[All,Clinics]",
-                        action=CheckModeAction,
-                        default="All",
-                        help="""All: Full calendar generated. Clinics: Just
-                            clinics generated""")
-    args = parser.parse_args()
-    main(args)
+    def replaced(self, students):
+        """Keys of 'rooms' without a date for these students whose sessions
+        all got the room of a row with their date instead, sorted"""
+        return self._sorted(key for key in self.superseded
+                            if key[0] in students and key not in self.used)
+    
+    @staticmethod
+    def _sorted(keys):
+        return sorted(keys, key=lambda key: (key[0], key[1], -1 if key[2] is None else key[2]))
+
+def readSeminarRooms(seminarFile):
+    """Reads the students' seminar rooms. Its first sheet has a row per
+    student per seminar with the columns Student (clinic ID), Clinic (key,
+    e.g. P1), Room and optionally Date (blank for all of that student's
+    sessions with the key) and Details; a row with a date wins over one
+    without, and a later row over an earlier one
+    
+    seminarFile (str)
+        Excel file containing the seminar rooms
+    returns (SeminarRooms)
+    """
+    from pandas import isna, read_excel, to_datetime
+    
+    seminars = read_excel(seminarFile, sheet_name=0)
+    missing = {"Student", "Clinic", "Room"} - set(seminars.columns)
+    if missing:
+        raise ValueError("{} has no {} column(s)".format(seminarFile,
+                                                          ", ".join(sorted(missing))))
+    for column in ("Date", "Details"):
+        if column not in seminars.columns:
+            seminars[column] = None
+    seminars = seminars.dropna(subset=["Student", "Clinic", "Room"])
+    
+    days = (to_datetime(seminars["Date"]).dt.normalize() - to_datetime("1970-01-01")).dt.days
+    rooms = {}
+    for (studentClinicID, clinicKey, day, room, details) in zip(
+            seminars["Student"], seminars["Clinic"], days, seminars["Room"],
+            seminars["Details"]):
+        rooms[(int(studentClinicID), str(clinicKey).strip(),
+               None if isna(day) else int(day))] = (
+            str(room).strip(), "" if isna(details) else str(details).strip())
+    return SeminarRooms(rooms)
+
+def readHospitalData(hospitalFile):
+    """Reads the hospital rotation schedule. Its first sheet has a row per
+    student per rotation session, with the columns Student (clinic ID), Date,
+    Slot (AM, PM1 or PM2; PM is read as PM1), Site and optionally Details.
+    
+    hospitalFile (str)
+        Excel file containing the hospital rotations
+    returns (pandas.DataFrame)
+        Columns Student, Day (local date in days since the epoch), Slot, Site
+        and Details; a later row for the same session replaces an earlier one
+    """
+    from pandas import read_excel, to_datetime
+    
+    hospital = read_excel(hospitalFile, sheet_name=0)
+    missing = {"Student", "Date", "Slot", "Site"} - set(hospital.columns)
+    if missing:
+        raise ValueError("{} has no {} column(s)".format(hospitalFile,
+                                                          ", ".join(sorted(missing))))
+    if "Details" not in hospital.columns:
+        hospital["Details"] = ""
+    hospital = hospital.dropna(subset=["Student", "Date", "Slot", "Site"])
+    
+    hospital["Student"] = hospital["Student"].astype(int)
+    dates = to_datetime(hospital["Date"]).dt.normalize()
+    hospital["Day"] = (dates - to_datetime("1970-01-01")).dt.days
+    hospital["Slot"] = hospital["Slot"].astype(str).str.strip().str.upper() \
+                                       .replace({"PM": "PM1"})
+    hospital["Site"] = hospital["Site"].astype(str).str.strip()
+    hospital["Details"] = hospital["Details"].fillna("").astype(str).str.strip()
+    return hospital.drop_duplicates(["Student", "Day", "Slot"], keep="last") \
+                   [["Student", "Day", "Slot", "Site", "Details"]]
+
+def joinHospitalData(clinicData, hospital, catalogue=None, dstTable=EASTERN_DST,
+                     warn=sys.stderr):
+    """Fills in the room and description of every hospital rotation session
+    in the clinic schedule with the site from the rotation schedule, joining
+    the two on (student, date, slot) in one merge
+    
+    clinicData (dict(int: dict(int: Session)))
+        Sessions by student clinic ID then start time, see readClinicData()
+    hospital (pandas.DataFrame)
+        Rotations, see readHospitalData()
+    catalogue (ClinicCatalogue) [ClinicCatalogue.default()]
+        What the clinic keys mean
+    dstTable (DSTTable) [EASTERN_DST]
+        Transition table of the desired timezone
+    warn (file or None) [sys.stderr]
+        Where to list rotations with no matching session, if anywhere
+    returns (int)
+        Number of sessions filled in
+    """
+    import numpy
+    from pandas import DataFrame
+    
+    if catalogue is None:
+        catalogue = ClinicCatalogue.default()
+    summary = catalogue.summaries.get("HR", "HR")
+    rotations = DataFrame([(studentClinicID, start, session.slot)
+                           for (studentClinicID, sessions) in clinicData.items()
+                           for (start, session) in sessions.items()
+                           if session is not None and session.clinic == summary],
+                          columns=["Student", "Start", "Slot"])
+    rotations = rotations.astype({"Student": "int64", "Start": "int64", "Slot": "object"})
+    
+    # Local date of each session, using the whole DST table at once (every
+    # start went through it already, so it covers them)
+    starts = rotations["Start"].to_numpy()
+    local = starts + numpy.asarray(dstTable.offsets, dtype="int64")[
+        numpy.searchsorted(dstTable.transitions, starts, side="right")]
+    rotations["Day"] = local // MINUTES_PER_DAY
+    
+    joined = rotations.merge(hospital, how="outer", on=["Student", "Day", "Slot"],
+                             indicator=True)
+    matched = joined[joined["_merge"] == "both"]
+    for (studentClinicID, start, site, details) in zip(matched["Student"],
+            matched["Start"].astype("int64"), matched["Site"], matched["Details"]):
+        session = clinicData[studentClinicID][start]
+        session.room = site
+        session.description = details
+    
+    if warn is not None:
+        unmatched = joined[joined["_merge"] == "right_only"]
+        for (studentClinicID, day, slot) in zip(unmatched["Student"],
+                                                unmatched["Day"], unmatched["Slot"]):
+            warn.write("warning: no hospital rotation session for student {} "
+                       "on {} {} in the clinic schedule\n".format(
+                           studentClinicID,
+                           date.fromordinal(int(day) + EPOCH_ORDINAL).isoformat(),
+                           slot))
+    return len(matched)
+
+def readSources(clinicFile, catalogue=None, layout=None, students=None, eventFilter=None,
+                hospitalFile=None, timer=None, seminarFile=None, warn=sys.stderr):
+    """Reads every data source personalized events are filled in from
+    
+    clinicFile (str)
+        Excel file containing clinic data
+    catalogue, layout, students, eventFilter
+        See readClinicData()
+    hospitalFile (str) [None]
+        Excel file of hospital rotations, see readHospitalData()
+    timer (StageTimer) [None]
+        Records how long each step took
+    seminarFile (str) [None]
+        Excel file of the students' seminar rooms, see readSeminarRooms()
+    warn (file or None) [sys.stderr]
+        Where to list seminar rooms and hospital rotations that no session
+        matched, if anywhere
+    returns (dict(str: dict(int: dict(int: Session))))
+        Each source's sessions by student clinic ID, then by start time
+    """
+    if timer is None:
+        timer = StageTimer()
+    if catalogue is None:
+        catalogue = ClinicCatalogue.default()
+    seminarRooms = None
+    if seminarFile is not None:
+        with timer.stage("seminars"):
+            seminarRooms = readSeminarRooms(seminarFile)
+    with timer.stage("clinics"):
+        clinicData = readClinicData(clinicFile, catalogue, layout, students, eventFilter,
+                                    seminarRooms)
+    if seminarRooms is not None and warn is not None:
+        # Sessions a filter left out never looked their rooms up
+        students = set(clinicData if eventFilter is None else ())
+        for (studentClinicID, clinicKey, day) in seminarRooms.unused(students):
+            warn.write("warning: no {} session for student {}{} in the clinic "
+                       "schedule\n".format(
+                           clinicKey, studentClinicID, "" if day is None else " on " +
+                           date.fromordinal(day + EPOCH_ORDINAL).isoformat()))
+        for (studentClinicID, clinicKey, _) in seminarRooms.replaced(students):
+            warn.write("warning: the {} room of student {} for every date is never "
+                       "used; rows with dates give all their sessions\n".format(
+                           clinicKey, studentClinicID))
+    if hospitalFile is not None:
+        with timer.stage("hospital"):
+            hospital = readHospitalData(hospitalFile)
+            hospital = hospital[hospital["Student"].isin(list(clinicData))]
+            if eventFilter is not None:
+                # Rotations on sessions the filter left out have nothing to join
+                if not eventFilter.keepsSession("HR", catalogue.colours.get("HR", "")):
+                    hospital = hospital.iloc[0:0]
+                if eventFilter.first is not None:
+                    hospital = hospital[hospital["Day"] >=
+                                        eventFilter.first.toordinal() - EPOCH_ORDINAL]
+                if eventFilter.last is not None:
+                    hospital = hospital[hospital["Day"] <=
+                                        eventFilter.last.toordinal() - EPOCH_ORDINAL]
+            joinHospitalData(clinicData, hospital, catalogue, warn=warn)
+    return {"clinics": clinicData}
+
+# Where the merge rules live unless --merge says otherwise
+MERGE_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "MergeRules.json")
+
+class MergeRules:
+    """Which faculty calendar events are placeholders for personalized ones,
+    and which data source fills them in.
+    
+    The rules are an ordered JSON list of objects with:
+        pattern (str)
+            Regex matched case-insensitively against the start of the event
+            summary; the first matching rule wins
+        source (str)
+            Data source holding each student's sessions (e.g. "clinics")
+        required (bool) [true]
+            Whether every occurrence must have a session; if not, occurrences
+            without one are left out
+        skipAt (str "HH:MM") and skipClinics (list(str)) [optional]
+            Leave out occurrences starting at that time whose session is one
+            of those clinic keys
+    Events no rule matches are copied as they are.
+    
+    Members:
+        rules (list(dict))
+            The rules in order
+    """
+    
+    # The shared, lazily loaded default rules
+    _default = None
+    
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._cache = {}
+        self._matcher = re.compile("|".join("(?P<r{}>{})".format(i, rule["pattern"])
+                                            for (i, rule) in enumerate(self.rules)),
+                                   re.IGNORECASE)
+    
+    @staticmethod
+    def load(rulesFile=MERGE_RULES_FILE):
+        """Reads and compiles a rules file
+        
+        rulesFile (str)
+            JSON file to read
+        returns (MergeRules)
+        """
+        with open(rulesFile) as handle:
+            return MergeRules(json.load(handle))
+    
+    @staticmethod
+    def default():
+        """The rules next to this script, loaded on first use"""
+        if MergeRules._default is None:
+            MergeRules._default = MergeRules.load()
+        return MergeRules._default
+    
+    def ruleFor(self, summary):
+        """Returns the rule personalizing events called 'summary', or None"""
+        try:
+            return self._cache[summary]
+        except KeyError:
+            pass
+        
+        match = self._matcher.match(summary.strip()) if self.rules else None
+        rule = None if match is None else self.rules[int(match.lastgroup[1:])]
+        self._cache[summary] = rule
+        return rule
+
+class TemplateEvent:
+    """One VEVENT of the faculty calendar, prepared once per run so that
+    students only cost lookups.
+    
+    Members:
+        component (icalendar.cal.Component)
+            The event itself (parsed on first use for compiled templates)
+        summary (str)
+            Its summary
+        category (str or None)
+            Colour category of its copy (events that aren't personalized)
+        source (str or None)
+            Data source personalizing it, or None if it is copied as is
+        required (bool)
+            Whether every occurrence must have a session in the source
+        occurrences (sequence(int))
+            Start of every occurrence in epoch minutes with EXDATEs removed
+        duration (int)
+            Minutes each occurrence lasts
+        allDay (bool)
+            Whether it is on dates rather than at times
+        location, description (str)
+            Its location and description (copied events only, for exports)
+        skipAt (int or None)
+            Local minute of the day at which some sessions are left out
+        skipSummaries (set(str))
+            Summaries of the sessions left out at skipAt
+        merges (int)
+            Number of personalized events serialized so far, see merge()
+    
+    Static methods:
+        fromComponent(component, rule, catalogue, categoryRules)
+            Prepares an event of a parsed faculty calendar
+    """
+    
+    def __init__(self, summary, source=None, required=True, occurrences=(),
+                 skipAt=None, skipSummaries=(), component=None, placeholder=None,
+                 copy=None, category=None, duration=0, allDay=False, location="",
+                 description=""):
+        from threading import Lock
+        
+        self.summary = summary
+        self.category = category
+        self.source = source
+        self.required = required
+        self.occurrences = occurrences
+        self.duration = duration
+        self.allDay = allDay
+        self.location = location
+        self.description = description
+        self.skipAt = skipAt
+        self.skipSummaries = set(skipSummaries)
+        self._component = component
+        # Serialized placeholder event, parsed into 'component' when needed
+        self._placeholder = placeholder
+        # Serialized copy split around its UID line, see splitAtUID()
+        self._copy = copy
+        # Raw event and what to keep of it, copied into _copy on first use
+        # (see passthroughEvent())
+        self._raw = None
+        self._passthrough = None
+        # Serialized personalized events split the same way, by session
+        self._merged = {}
+        # How many personalized events were asked of merge(), counted under
+        # a lock since generators are shared between threads
+        self.merges = 0
+        self._mergesLock = Lock()
+    
+    @staticmethod
+    def fromComponent(component, rule=None, catalogue=None, categoryRules=None,
+                      dstTable=EASTERN_DST, raw=None, passthrough=None):
+        """Prepares an event of a parsed faculty calendar
+        
+        component (icalendar.cal.Component)
+            A VEVENT from the faculty calendar
+        rule (dict or None) [None]
+            The merge rule personalizing it, see MergeRules
+        catalogue (ClinicCatalogue) [ClinicCatalogue.default()]
+            What the clinic keys mean
+        categoryRules (CategoryRules) [CategoryRules.default()]
+            How to recolour it if it is copied
+        dstTable (DSTTable) [EASTERN_DST]
+            Transition table of the desired timezone
+        raw (bytes) [None]
+            The event as it is in the calendar file, see splitRawEvents()
+        passthrough (set(str)) [None]
+            If given, a copy is made from 'raw' keeping just these properties
+            (see passthroughEvent()) instead of being re-encoded
+        returns (TemplateEvent)
+        """
+        summary = str(component.get("summary"))
+        if rule is None:
+            if categoryRules is None:
+                categoryRules = CategoryRules.default()
+            # Only events with a category of their own are recoloured (and
+            # reported if no rule matches), see createNonClinicEvent()
+            recolour = None
+            category = None
+            if "categories" in component:
+                recolour = categoryRules.categorize(summary)
+                category = recolour or component.get("categories").to_ical().decode()
+            templateEvent = TemplateEvent(summary,
+                                          occurrences=expandOccurrences(component, dstTable),
+                                          component=component, category=category,
+                                          duration=eventDuration(component),
+                                          allDay=not isinstance(component.get("dtstart").dt,
+                                                                datetime),
+                                          location=str(component.get("location", "")),
+                                          description=str(component.get("description", "")))
+            if passthrough is None:
+                # Serialize the copy once; students only get their own UID line
+                templateEvent._copy = splitAtUID(
+                    createNonClinicEvent(component, 0, categoryRules).to_ical())
+            else:
+                templateEvent._raw = raw
+                templateEvent._passthrough = (passthrough, recolour)
+            return templateEvent
+        
+        if catalogue is None:
+            catalogue = ClinicCatalogue.default()
+        skipAt = None
+        skipSummaries = ()
+        if "skipAt" in rule:
+            hour, minute = rule["skipAt"].split(":")
+            skipAt = int(hour) * 60 + int(minute)
+            skipSummaries = [catalogue.summaries.get(key, key)
+                             for key in rule.get("skipClinics", [])]
+        return TemplateEvent(summary, rule["source"], rule.get("required", True),
+                             expandOccurrences(component, dstTable), skipAt,
+                             skipSummaries, component=component,
+                             duration=eventDuration(component))
+    
+    @property
+    def component(self):
+        if self._component is None:
+            from icalendar import Event
+            self._component = Event.from_ical(bytes(self._placeholder))
+        return self._component
+    
+    def copySplit(self):
+        """The serialized copy of an event that isn't personalized, split
+        around its UID line (see splitAtUID())"""
+        if self._copy is None:
+            # Threads racing to make it make the same bytes
+            allowed, category = self._passthrough
+            self._copy = passthroughEvent(self._raw, allowed, category)
+        return self._copy
+    
+    def copy(self, uidCounter):
+        """The serialized copy of an event that isn't personalized
+        
+        uidCounter (int)
+            Which UID to give it
+        returns (bytes)
+        """
+        return joinAtUID(self.copySplit(), uidCounter)
+    
+    def merge(self, session, uidCounter):
+        """The serialized event of one personalized occurrence
+        
+        session (Session)
+            The student's session at this occurrence
+        uidCounter (int)
+            Which UID to give it
+        returns (bytes)
+        """
+        # Many students share a session, so each is only serialized once.
+        # Threads racing to serialize the same one produce the same bytes
+        key = (session.clinic, session.room, session.description, session.start,
+               session.end, session.colour)
+        with self._mergesLock:
+            self.merges += 1
+        split = self._merged.get(key)
+        if split is None:
+            split = self._merged.setdefault(key, splitAtUID(
+                createClinicEvent(self.component, session, 0).to_ical()))
+        return joinAtUID(split, uidCounter)
+
+def prepareTemplate(components, mergeRules=None, catalogue=None, categoryRules=None,
+                    rawEvents=None, passthrough=None):
+    """Matches every event of the faculty calendar against the merge rules,
+    expands the recurrences of the personalized ones and serializes the rest,
+    once
+    
+    components (list(icalendar.cal.Component))
+        Everything in the faculty calendar
+    mergeRules (MergeRules) [MergeRules.default()]
+        Which events are personalized by which data source
+    catalogue (ClinicCatalogue) [ClinicCatalogue.default()]
+        What the clinic keys mean
+    categoryRules (CategoryRules) [CategoryRules.default()]
+        How to recolour events that aren't personalized
+    rawEvents (list(bytes)) [None]
+        The events as they are in the file, see splitRawEvents()
+    passthrough (set(str)) [None]
+        If given, events that aren't personalized are copied from
+        'rawEvents' keeping just these properties, see passthroughEvent()
+    returns (list(TemplateEvent))
+        The calendar's events, in order
+    """
+    if mergeRules is None:
+        mergeRules = MergeRules.default()
+    events = [c for c in components if c.name == "VEVENT"]
+    if rawEvents is None:
+        rawEvents = [None] * len(events)
+    elif len(rawEvents) != len(events):
+        raise ValueError("Found {} events in the calendar file but parsed {}".format(
+                            len(rawEvents), len(events)))
+    return [TemplateEvent.fromComponent(c, mergeRules.ruleFor(str(c.get("summary"))),
+                                        catalogue, categoryRules, raw=raw,
+                                        passthrough=passthrough)
+            for (c, raw) in zip(events, rawEvents)]
+
+def uidLine(uidCounter):
+    """The UID content line of an event, folded like icalendar does: 74
+    characters per line plus the space starting each continuation (UIDs are
+    plain ASCII)
+    
+    uidCounter (int)
+        Which UID
+    returns (bytes)
+    """
+    line = "UID:{:X}".format(UID + uidCounter)
+    pieces = [line[i:i+74] for i in range(0, len(line), 74)]
+    return ("\r\n ".join(pieces) + "\r\n").encode()
+
+def splitAtUID(data):
+    """Splits a serialized event numbered 0 around its UID line so that it
+    can be given any UID with joinAtUID()
+    
+    data (bytes)
+        The serialized event
+    returns (bytes, bytes or None)
+        What comes before and after the UID line, with None after if the
+        event has no UID
+    """
+    line = uidLine(0)
+    if line not in data:
+        return (data, None)
+    i = data.index(line)
+    return (data[:i], data[i + len(line):])
+
+def joinAtUID(split, uidCounter):
+    """The serialized event split by splitAtUID(), numbered 'uidCounter'"""
+    before, after = split
+    if after is None:
+        return bytes(before)
+    return b"".join((before, uidLine(uidCounter), after))
+
+def calendarHeader(cal):
+    """What every generated calendar starts with, up to its first event
+    
+    cal (icalendar.Calendar)
+        The faculty calendar
+    returns (bytes)
+    """
+    from icalendar import Calendar
+    
+    header = Calendar()
+    header.add("prodid", cal.get("prodid"))
+    header.add("version", cal.get("version"))
+    return header.to_ical()[:-len(CALENDAR_FOOTER)]
+
+# What every generated calendar ends with
+CALENDAR_FOOTER = b"END:VCALENDAR\r\n"
+
+# Compiled templates start with this magic (and format version), the digest
+# of their sources and the size of their JSON table of contents
+COMPILED_TEMPLATE_MAGIC = b"DCTPL\x00\x00\x05"
+COMPILED_TEMPLATE_HEADER = struct.Struct("<8s40sI4x")
+
+def saveTemplate(path, sourceDigest, header, template):
+    """Compiles a prepared faculty calendar into a binary file that later
+    runs can memory-map instead of parsing the calendar again. Occurrences
+    are stored as native 64-bit integers, so the file only suits the machine
+    that wrote it.
+    
+    path (str)
+        Where to write it
+    sourceDigest (str)
+        Digest of everything the template was prepared from, see
+        digestSources()
+    header (bytes)
+        See calendarHeader()
+    template (list(TemplateEvent))
+        See prepareTemplate()
+    """
+    from array import array
+    
+    blobs = []
+    size = 0
+    def place(data):
+        nonlocal size
+        offset = size
+        blobs.append(data)
+        size += len(data)
+        padding = -size % 8 # Keep everything 8-byte aligned
+        blobs.append(b"\0" * padding)
+        size += padding
+        return offset
+    
+    contents = {"header": [place(header), len(header)], "events": []}
+    for templateEvent in template:
+        entry = {"summary": templateEvent.summary,
+                 "occurrences": [place(array("q", templateEvent.occurrences).tobytes()),
+                                 len(templateEvent.occurrences)],
+                 "duration": templateEvent.duration}
+        if templateEvent.source is None:
+            before, after = templateEvent.copySplit()
+            entry["copy"] = [place(before + (after or b"")), len(before),
+                             -1 if after is None else len(after)]
+            entry["category"] = templateEvent.category
+            # Whether loading it has to categorize its summary, like
+            # fromComponent() did
+            entry["categorized"] = templateEvent.category is not None
+            entry["allDay"] = templateEvent.allDay
+            entry["location"] = templateEvent.location
+            entry["description"] = templateEvent.description
+        else:
+            placeholder = templateEvent.component.to_ical()
+            entry["source"] = templateEvent.source
+            entry["required"] = templateEvent.required
+            entry["skipAt"] = templateEvent.skipAt
+            entry["skipSummaries"] = sorted(templateEvent.skipSummaries)
+            entry["placeholder"] = [place(placeholder), len(placeholder)]
+        contents["events"].append(entry)
+    
+    table = json.dumps(contents).encode()
+    table += b" " * (-len(table) % 8)
+    writeAtomic(path, COMPILED_TEMPLATE_HEADER.pack(COMPILED_TEMPLATE_MAGIC,
+                                                    sourceDigest.encode(), len(table))
+                      + table + b"".join(blobs))
+
+def loadTemplate(path, sourceDigest, categoryRules=None):
+    """Memory-maps a template compiled by saveTemplate()
+    
+    path (str)
+        The compiled template
+    sourceDigest (str)
+        Digest of the current sources; a template compiled from others is stale
+    categoryRules (CategoryRules) [CategoryRules.default()]
+        Told about the copied summaries so that its report still lists them
+    returns (bytes, list(TemplateEvent)) or None
+        The calendar header and the prepared events, or None if the file is
+        missing, stale or not a compiled template
+    """
+    import mmap
+    
+    if categoryRules is None:
+        categoryRules = CategoryRules.default()
+    try:
+        with open(path, "rb") as handle:
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(mapped) < COMPILED_TEMPLATE_HEADER.size:
+        return None
+    magic, digest, tableSize = COMPILED_TEMPLATE_HEADER.unpack_from(mapped)
+    if magic != COMPILED_TEMPLATE_MAGIC or digest != sourceDigest.encode():
+        return None
+    
+    start = COMPILED_TEMPLATE_HEADER.size + tableSize
+    contents = json.loads(mapped[COMPILED_TEMPLATE_HEADER.size:start])
+    data = memoryview(mapped)[start:]
+    def blob(offset, length):
+        return data[offset:offset + length]
+    
+    template = []
+    for entry in contents["events"]:
+        offset, count = entry["occurrences"]
+        occurrences = blob(offset, 8 * count).cast("q")
+        if "copy" in entry:
+            offset, before, after = entry["copy"]
+            copy = (blob(offset, before),
+                    None if after < 0 else blob(offset + before, after))
+            if entry["categorized"]:
+                categoryRules.categorize(entry["summary"])
+            template.append(TemplateEvent(entry["summary"], occurrences=occurrences,
+                                          copy=copy, category=entry["category"],
+                                          duration=entry["duration"],
+                                          allDay=entry["allDay"],
+                                          location=entry["location"],
+                                          description=entry["description"]))
+        else:
+            template.append(TemplateEvent(entry["summary"], entry["source"],
+                                          entry["required"], occurrences,
+                                          entry["skipAt"], entry["skipSummaries"],
+                                          placeholder=blob(*entry["placeholder"]),
+                                          duration=entry["duration"]))
+    return (bytes(blob(*contents["header"])), template)
+
+def expandOccurrences(component, dstTable=EASTERN_DST):
+    """Every occurrence of an event, following its RRULE (if any) and leaving
+    out its EXDATEs. Occurrences keep the wall-clock time of DTSTART across
+    daylight saving time changes, and rules without an end stop after a year.
+    
+    component (icalendar.cal.Component)
+        A VEVENT from the faculty calendar
+    dstTable (DSTTable) [EASTERN_DST]
+        Transition table of the desired timezone
+    returns (list(int))
+        Start of each occurrence in epoch minutes, in order
+    """
+    from dateutil.rrule import rrulestr
+    
+    dtstart = component.get("dtstart").dt
+    start = datetime(dtstart.year, dtstart.month, dtstart.day,
+                     getattr(dtstart, "hour", 0), getattr(dtstart, "minute", 0))
+    rule = component.get("rrule")
+    if rule is None:
+        starts = [start]
+    else:
+        text = rule.to_ical().decode()
+        try:
+            # A timezone-aware start lets dateutil compare against a UTC UNTIL
+            first = start.replace(tzinfo=dstTable.timezone)
+            recurrence = rrulestr(text, dtstart=first)
+        except ValueError:
+            # ...but a floating UNTIL needs a floating start
+            first = start
+            recurrence = rrulestr(text, dtstart=first)
+        if "COUNT" in rule or "UNTIL" in rule:
+            starts = list(recurrence)
+        else:
+            starts = recurrence.between(first, first.replace(year=first.year + 1),
+                                        inc=True)
+    
+    exdates = component.get("exdate", [])
+    if not isinstance(exdates, list):
+        exdates = [exdates]
+    skipTimes = set()
+    skipDates = set()
+    for exdateList in exdates:
+        for exdate in exdateList.dts:
+            if isinstance(exdate.dt, datetime):
+                skipTimes.add(datetimeToEpochMinutes(exdate.dt, dstTable))
+            else:
+                skipDates.add(exdate.dt)
+    
+    occurrences = []
+    for occurrence in starts:
+        epochMinutes = standardizeDatetime(occurrence, dstTable)
+        if epochMinutes in skipTimes or occurrence.date() in skipDates:
+            continue
+        occurrences.append(epochMinutes)
+    return occurrences
+
+def eventDuration(component):
+    """How many minutes each occurrence of an event lasts; events with a start
+    date but no end last the day
+    
+    component (icalendar.cal.Component)
+        A VEVENT from the faculty calendar
+    returns (int)
+    """
+    dtstart = component.get("dtstart").dt
+    if "dtend" in component:
+        length = component.get("dtend").dt - dtstart
+    elif "duration" in component:
+        length = component.get("duration").dt
+    elif isinstance(dtstart, datetime):
+        return 0
+    else:
+        return MINUTES_PER_DAY
+    return int(length.total_seconds()) // 60
+
+def createNonClinicEvent(component, uidCounter, categoryRules=None):
+    """Copies a non-clinic event from the faculty calendar, recolouring it and
+    dropping the Outlook-only properties
+    
+    component (icalendar.cal.Component)
+        A VEVENT from the faculty calendar
+    uidCounter (int)
+        Which UID to give the copy
+    categoryRules (CategoryRules) [CategoryRules.default()]
+        How to recolour it
+    returns (icalendar.Event)
+        The new event
+    """
+    from icalendar import Event
+    from icalendar.prop import vText
+    
+    if categoryRules is None:
+        categoryRules = CategoryRules.default()
+    
+    event = Event()
+    for k in component.keys():
+        k = k.lower()
+        if k == "categories":
+            category = categoryRules.categorize(str(component.get("summary")))
+            if category is not None:
+                event.add("categories", vText(category))
+            else:
+                event.add("categories", component.get("categories"))
+        elif k == "uid":
+            event.add("UID", "{:X}".format(UID + uidCounter))
+        elif k == "x-alt-desc" \
+                or k == "x-microsoft-cdo-busystatus" \
+                or k == "x-microsoft-cdo-importance" \
+                or k == "x-microsoft-disallow-counter":
+            pass
+        else:
+            event.add(k, component.get(k))
+    return event
+
+def createClinicEvent(component, session, uidCounter):
+    """Creates the event for one clinic session, filling in the details of the
+    placeholder event it replaces
+    
+    component (icalendar.cal.Component)
+        The "Clinical Practice" VEVENT from the faculty calendar
+    session (Session)
+        The student's session at this occurrence
+    uidCounter (int)
+        Which UID to give the event
+    returns (icalendar.Event)
+        The new event
+    """
+    from icalendar import Event
+    from icalendar.prop import vText
+    
+    # Add a bunch of junk to make the calendar uptake it
+    event = Event()
+    event.add("categories", vText(session.colour))
+    event.add("class", component.get("class"))
+    event.add("created", component.get("created"))
+    event.add("dtstart", epochMinutesToDatetime(session.start))
+    event.add("dtend", epochMinutesToDatetime(session.end))
+    event.add("dtstamp", component.get("dtstamp"))
+    event.add("description", session.description)
+    event.add("last-modified", component.get("last-modified"))
+    event.add("location", session.room)
+    event.add("priority", component.get("priority"))
+    event.add("sequence", component.get("sequence"))
+    event.add("summary", session.clinic)
+    event.add("transp", component.get("transp"))
+    event.add("UID", "{:X}".format(UID + uidCounter))
+    return event
+
+# Fingerprint of events copied from the faculty calendar; what they depend on
+# is covered by digestSources()
+TEMPLATE_FINGERPRINT = "T"
+
+def sessionFingerprint(session):
+    """Short digest of everything a clinic event is built from"""
+    import hashlib
+    
+    text = "\x1f".join((session.clinic, session.room, session.description,
+                        str(session.start), str(session.end), session.colour))
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+def digestSources(mode, *files):
+    """Digest of the mode and input files that every event of a calendar
+    depends on; a calendar generated from different ones can't be patched
+    
+    mode (str)
+        Output mode, or what else the digest is for
+    files (str)
+        Files to include
+    returns (str)
+    """
+    import hashlib
+    
+    digest = hashlib.sha1(mode.encode())
+    for path in files:
+        with open(path, "rb") as handle:
+            digest.update(handle.read())
+    return digest.hexdigest()
+
+class StudentEvent:
+    """One event of a student's calendar on its way down the pipeline of
+    studentEvents(); each stage fills in a little more of it.
+    
+    Members:
+        templateEvent (TemplateEvent)
+            The faculty calendar event it comes from
+        start (int or None)
+            Start of the occurrence in epoch minutes (personalized events only)
+        session (Session or None)
+            The student's session at that occurrence (personalized events only)
+        category (str or None)
+            Its colour category
+        uidCounter (int or None)
+            Which UID it gets
+    """
+    
+    __slots__ = ("templateEvent", "start", "session", "category", "uidCounter")
+    
+    def __init__(self, templateEvent, start=None):
+        self.templateEvent = templateEvent
+        self.start = start
+        self.session = None
+        self.category = None
+        self.uidCounter = None
+    
+    @property
+    def uid(self):
+        return "{:X}".format(UID + self.uidCounter)
+    
+    def fingerprint(self):
+        """Short digest of what the event is built from"""
+        if self.session is None:
+            return TEMPLATE_FINGERPRINT
+        return sessionFingerprint(self.session)
+    
+    def serialize(self):
+        """The event as it goes into the .ics file (bytes)"""
+        if self.session is None:
+            return self.templateEvent.copy(self.uidCounter)
+        return self.templateEvent.merge(self.session, self.uidCounter)
+    
+    def records(self, eventFilter=None):
+        """The event as it goes into JSON exports, one record per occurrence
+        (see EXPORT_SCHEMA)
+        
+        eventFilter (EventFilter) [None]
+            Which occurrences of copied events are wanted
+        yields (dict)
+        """
+        templateEvent = self.templateEvent
+        session = self.session
+        if session is not None:
+            yield {"uid": self.uid, "summary": session.clinic,
+                   "start": exportTime(session.start), "end": exportTime(session.end),
+                   "allDay": False, "location": session.room,
+                   "description": session.description, "category": self.category,
+                   "personalized": True}
+            return
+        
+        occurrences = templateEvent.occurrences
+        first, last = (0, len(occurrences))
+        if eventFilter is not None:
+            first, last = eventFilter.occurrenceRange(occurrences)
+        for i in range(first, last):
+            start = occurrences[i]
+            yield {"uid": self.uid, "summary": templateEvent.summary,
+                   "start": exportTime(start, templateEvent.allDay),
+                   "end": exportTime(start, templateEvent.allDay, templateEvent.duration),
+                   "allDay": templateEvent.allDay, "location": templateEvent.location,
+                   "description": templateEvent.description, "category": self.category,
+                   "personalized": False}
+
+class EventFilter:
+    """Which events go into the calendars when only part of them is wanted.
+    It is applied as early as possible: sessions are left out as the Excel
+    file is read, occurrences outside the dates are never expanded, and
+    copied events are dropped before anything is built from them. Recurring
+    copied events are kept whole if any occurrence is within the dates.
+    
+    Members:
+        first, last (date or None)
+            First and last day wanted
+        start, end (int or None)
+            The same as epoch minutes, [start, end)
+        categories (set(str) or None)
+            Only events of these colour categories
+        excludeCategories (set(str))
+            No events of these colour categories
+        clinicKeys (set(str) or None)
+            Only clinic sessions with these keys
+    """
+    
+    def __init__(self, first=None, last=None, categories=None, excludeCategories=(),
+                 clinicKeys=None, dstTable=EASTERN_DST):
+        self.first = first
+        self.last = last
+        self.start = None
+        self.end = None
+        if first is not None:
+            self.start = localToEpochMinutes(first.year, first.month, first.day, 0, 0,
+                                             dstTable)
+        if last is not None:
+            self.end = localToEpochMinutes(last.year, last.month, last.day, 0, 0,
+                                           dstTable) + MINUTES_PER_DAY
+        self.categories = None if categories is None else set(categories)
+        self.excludeCategories = set(excludeCategories)
+        self.clinicKeys = None if clinicKeys is None else set(clinicKeys)
+    
+    def describe(self):
+        """What is filtered, as text ("" if nothing is)"""
+        parts = []
+        if self.first is not None:
+            parts.append("from {}".format(self.first.isoformat()))
+        if self.last is not None:
+            parts.append("to {}".format(self.last.isoformat()))
+        if self.categories is not None:
+            parts.append("categories {}".format(",".join(sorted(self.categories))))
+        if self.excludeCategories:
+            parts.append("not {}".format(",".join(sorted(self.excludeCategories))))
+        if self.clinicKeys is not None:
+            parts.append("clinics {}".format(",".join(sorted(self.clinicKeys))))
+        return "; ".join(parts)
+    
+    def keepsDay(self, day):
+        """Whether anything on 'day' (date or datetime) is wanted"""
+        day = date(day.year, day.month, day.day)
+        return (self.first is None or day >= self.first) \
+               and (self.last is None or day <= self.last)
+    
+    def keepsCategory(self, category):
+        """Whether events of colour 'category' are wanted"""
+        if category in self.excludeCategories:
+            return False
+        return self.categories is None or category in self.categories
+    
+    def keepsSession(self, clinicKey, colour):
+        """Whether a clinic session is wanted"""
+        return self.keepsCategory(colour) \
+               and (self.clinicKeys is None or clinicKey in self.clinicKeys)
+    
+    def occurrenceRange(self, occurrences):
+        """(first, last + 1) index of the occurrences starting within the
+        dates, out of starts in order"""
+        return (0 if self.start is None else bisect_left(occurrences, self.start),
+                len(occurrences) if self.end is None else bisect_left(occurrences, self.end))
+    
+    def keepsCopy(self, templateEvent):
+        """Whether an event that isn't personalized is wanted"""
+        if not self.keepsCategory(templateEvent.category):
+            return False
+        if self.start is None and self.end is None:
+            return True
+        occurrences = templateEvent.occurrences
+        # The first occurrence still going on at the start, if it starts in time
+        i = 0
+        if self.start is not None:
+            i = bisect_right(occurrences, self.start - max(templateEvent.duration, 1))
+        return i < len(occurrences) and (self.end is None or occurrences[i] < self.end)
+
+def templateSource(template, mode, eventFilter=None):
+    """First stage of studentEvents(): the faculty calendar events that go
+    into the calendars of the given mode
+    
+    template (list(TemplateEvent))
+        The faculty calendar, see prepareTemplate()
+    mode ("All","Clinics","Shared")
+        Whether events that aren't personalized are included
+    eventFilter (EventFilter) [None]
+        Which of them are wanted
+    yields (TemplateEvent)
+    """
+    for templateEvent in template:
+        if templateEvent.source is None:
+            if mode != "All":
+                continue
+            if eventFilter is not None and not eventFilter.keepsCopy(templateEvent):
+                continue
+        yield templateEvent
+
+def expandRecurrences(templateEvents, eventFilter=None):
+    """Second stage of studentEvents(): an event per occurrence of each
+    personalized event, and one per copied event
+    
+    templateEvents (iterable(TemplateEvent))
+    eventFilter (EventFilter) [None]
+        Which dates are wanted
+    yields (StudentEvent)
+    """
+    for templateEvent in templateEvents:
+        if templateEvent.source is None:
+            yield StudentEvent(templateEvent)
+            continue
+        occurrences = templateEvent.occurrences
+        if eventFilter is None:
+            first, last = (0, len(occurrences))
+        else:
+            first, last = eventFilter.occurrenceRange(occurrences)
+        for i in range(first, last):
+            yield StudentEvent(templateEvent, occurrences[i])
+
+def joinSessions(events, sources, studentClinicID):
+    """Third stage of studentEvents(): looks up the student's session at
+    every personalized occurrence, leaving out the ones the merge rules say to
+    
+    events (iterable(StudentEvent))
+    sources (dict(str: dict(int: dict(int: Session))))
+        Each data source's sessions by student clinic ID, then by start time
+        in epoch minutes; None for sessions filtered out as they were read
+    studentClinicID (int)
+        Which student
+    yields (StudentEvent)
+    """
+    for event in events:
+        templateEvent = event.templateEvent
+        if templateEvent.source is None:
+            yield event
+            continue
+        
+        sessions = sources[templateEvent.source].get(studentClinicID, {})
+        if event.start not in sessions:
+            if templateEvent.required:
+                raise LookupError("No '{}' session for student {} at {} ({})".format(
+                    templateEvent.source, studentClinicID,
+                    epochMinutesToDatetime(event.start).strftime("%Y-%m-%d %H:%M"),
+                    templateEvent.summary))
+            continue
+        session = sessions[event.start]
+        if session is None: # Filtered out, see EventFilter
+            continue
+        
+        # e.g. if this is a PM2 session for AGP and the Excel file says
+        # that it's a study time or faculty time, skip it
+        if templateEvent.skipAt is not None \
+                and minuteOfDay(event.start) == templateEvent.skipAt \
+                and session.clinic in templateEvent.skipSummaries:
+            continue
+        
+        event.session = session
+        yield event
+
+def categorize(events):
+    """Fourth stage of studentEvents(): personalized events take their
+    session's colour, copies the one chosen when the template was prepared
+    
+    events (iterable(StudentEvent))
+    yields (StudentEvent)
+    """
+    for event in events:
+        if event.session is None:
+            event.category = event.templateEvent.category
+        else:
+            event.category = event.session.colour
+        yield event
+
+def assignUIDs(events, firstUID=0):
+    """Fifth stage of studentEvents(): numbers the events in calendar order
+    
+    events (iterable(StudentEvent))
+    firstUID (int) [0]
+        UID counter of the first event
+    yields (StudentEvent)
+    """
+    for (uidCounter, event) in enumerate(events, firstUID):
+        event.uidCounter = uidCounter
+        yield event
+
+def studentEvents(template, sources, studentClinicID, mode, firstUID=0, eventFilter=None):
+    """Merges one student's data into the prepared faculty calendar. The
+    stages are chained generators, so events are built one at a time as the
+    consumer (e.g. serializeEvents()) pulls them
+    
+    template (list(TemplateEvent))
+        The faculty calendar, see prepareTemplate()
+    sources (dict(str: dict(int: dict(int: Session))))
+        Each data source's sessions by student clinic ID, then by start time
+        in epoch minutes
+    studentClinicID (int)
+        Which student
+    mode ("All","Clinics","Shared")
+        Whether events that aren't personalized are included
+    firstUID (int) [0]
+        UID counter of the first event
+    eventFilter (EventFilter) [None]
+        Which events are wanted; 'sources' must have been read with it
+    returns (iterator(StudentEvent))
+        The student's events in calendar order
+    """
+    events = templateSource(template, mode, eventFilter)
+    events = expandRecurrences(events, eventFilter)
+    events = joinSessions(events, sources, studentClinicID)
+    events = categorize(events)
+    return assignUIDs(events, firstUID)
+
+def serializeEvents(events, entries=None, records=None, eventFilter=None):
+    """Last stage: the serialized events, ready to go between a calendar's
+    header and footer
+    
+    events (iterable(StudentEvent))
+    entries (list) [None]
+        If given, the (UID, fingerprint) of each event is appended to it
+        (see indexCalendar())
+    records (list) [None]
+        If given, the export records of each event are appended to it (see
+        StudentEvent.records()), in the same pass
+    eventFilter (EventFilter) [None]
+        Which occurrences of copied events go into 'records'
+    yields (bytes)
+    """
+    for event in events:
+        if entries is not None:
+            entries.append((event.uid, event.fingerprint()))
+        if records is not None:
+            records.extend(event.records(eventFilter))
+        yield event.serialize()
+
+def indexCalendar(data, entries, sourceDigest):
+    """Builds the .idx sidecar of a serialized calendar: where every event's
+    block starts and ends, and what it was built from
+    
+    data (bytes)
+        The serialized calendar
+    entries (list(tuple(str, str)))
+        (UID, fingerprint) of each event in calendar order
+    sourceDigest (str)
+        See digestSources()
+    returns (dict)
+        The index, ready for json.dump
+    """
+    events = []
+    position = 0
+    for (uid, fingerprint) in entries:
+        start = data.index(b"BEGIN:VEVENT\r\n", position)
+        position = data.index(b"END:VEVENT\r\n", start) + len(b"END:VEVENT\r\n")
+        events.append([uid, start, position - start, fingerprint])
+    return {"source": sourceDigest, "size": len(data), "events": events}
+
+def patchCalendar(path, events, sourceDigest):
+    """Brings a previously generated calendar up to date by only rewriting
+    the events whose fingerprints changed, using its .idx sidecar. The file
+    is spliced together from the old and new blocks and renamed into place
+    (see writeAtomic()), so readers never see it half patched.
+    
+    path (str)
+        The calendar to patch
+    events (iterable(StudentEvent))
+        The calendar's events, see studentEvents()
+    sourceDigest (str)
+        See digestSources()
+    returns (int or None)
+        Number of events rewritten, or None if the calendar has no usable
+        index (it's missing, stale, or events were added or removed) and has
+        to be written in full
+    """
+    indexPath = path + ".idx"
+    try:
+        with open(indexPath) as handle:
+            index = json.load(handle)
+        size = os.path.getsize(path)
+    except (OSError, ValueError):
+        return None
+    if index["source"] != sourceDigest or index["size"] != size:
+        return None
+    
+    # Find what changed, only building those events
+    indexed = index["events"]
+    changes = []
+    count = 0
+    for event in events:
+        if count >= len(indexed) or indexed[count][0] != event.uid:
+            return None
+        fingerprint = event.fingerprint()
+        if indexed[count][3] != fingerprint:
+            changes.append((count, event.serialize(), fingerprint))
+        count += 1
+    if count != len(indexed):
+        return None
+    if not changes:
+        return 0
+    
+    with open(path, "rb") as handle:
+        old = handle.read()
+    pieces = []
+    position = 0
+    shift = 0
+    changed = {i: (block, fingerprint) for (i, block, fingerprint) in changes}
+    for (i, entry) in enumerate(indexed):
+        entry[1] += shift
+        if i in changed:
+            block, entry[3] = changed[i]
+            start = entry[1] - shift
+            pieces.append(old[position:start])
+            pieces.append(block)
+            position = start + entry[2]
+            shift += len(block) - entry[2]
+            entry[2] = len(block)
+    pieces.append(old[position:])
+    data = b"".join(pieces)
+    index["size"] = len(data)
+    writeAtomic(path, data)
+    writeAtomic(indexPath, json.dumps(index).encode())
+    return len(changes)
+
+class CalendarGenerator:
+    """Everything needed to generate the students' calendars, loaded once so
+    that a long-lived process can generate any of them on request.
+    
+    Construction reads the Excel file(s) and the faculty calendar (or its
+    compiled template); after that the only things modified are the cache of
+    serialized sessions, which is safe to race on, and the count of
+    personalized events (see sessionCacheStats()), which is locked, so any
+    number of threads may call generate(), iterEvents(), generateMany() and
+    cohort() at once.
+    
+        generator = CalendarGenerator("clinic.xlsx", "Calendar 1-30.ics")
+        data = generator.generate(5)
+    
+    Members:
+        mode ("All","Clinics","Shared")
+            Which events go into the student calendars
+        header (bytes)
+            What every calendar starts with, see calendarHeader()
+        template (list(TemplateEvent))
+            The prepared faculty calendar
+        sources (dict(str: dict(int: dict(int: Session))))
+            Sessions by data source, student clinic ID and start time
+        categoryRules (CategoryRules)
+            How events that aren't personalized were recoloured
+        sourceDigest (str)
+            Digest of the inputs every event depends on, see digestSources()
+        firstUID (int)
+            UID counter of each student calendar's first event
+        eventFilter (EventFilter or None)
+            Which events are wanted, if not all
+        templateCacheHit (bool or None)
+            Whether the compiled template was used (None without one)
+        unknownClinicKeys (dict(str: int))
+            Clinic keys read that the catalogue doesn't have, see
+            ClinicCatalogue.unknown
+    """
+    
+    def __init__(self, clinicFile, calendarFile, mode="All",
+                 catalogueFile=CLINIC_CATALOGUE_FILE, rulesFile=CATEGORY_RULES_FILE,
+                 mergeFile=MERGE_RULES_FILE, hospitalFile=None, templateCache=None,
+                 layout=None, students=None, sources=None, eventFilter=None,
+                 timer=None, passthrough=None, seminarFile=None):
+        """Loads everything
+        
+        clinicFile (str)
+            Excel file containing clinic data
+        calendarFile (str)
+            Microsoft Calendar .ics file containing class schedule
+        mode ("All","Clinics","Shared") ["All"]
+            All: everything. Clinics: just clinics. Shared: just clinics, with
+            everything else in the cohort() calendar
+        catalogueFile, rulesFile, mergeFile (str) [next to this script]
+            ClinicCatalogue.json, CategoryRules.json and MergeRules.json
+        hospitalFile (str) [None]
+            Excel file of hospital rotations, see readHospitalData()
+        templateCache (str) [None]
+            Compiled template to start from (and keep up to date), see
+            saveTemplate()
+        layout [clinicLayout()]
+            Where the sessions are in clinicFile, see loadLayout()
+        students (iterable(int)) [everyone in clinicFile]
+            Which students' sessions to read
+        sources (dict) [None]
+            Sessions already read by another generator (its .sources), used
+            instead of reading clinicFile, hospitalFile and seminarFile again
+        eventFilter (EventFilter) [None]
+            Which events are wanted (the same as 'sources' was read with)
+        timer (StageTimer) [None]
+            Records how long each step took
+        passthrough (set(str)) [None]
+            If given, events that aren't personalized are copied from the
+            calendar file as they are, keeping just these properties (see
+            passthroughEvent())
+        seminarFile (str) [None]
+            Excel file of the students' seminar rooms, see readSeminarRooms()
+        """
+        if timer is None:
+            timer = StageTimer()
+        self.mode = mode
+        self.eventFilter = eventFilter
+        catalogue = ClinicCatalogue.load(catalogueFile)
+        self.categoryRules = CategoryRules.load(rulesFile)
+        
+        # Reuse the compiled template if it was compiled from these very
+        # files, else parse the calendar (and compile it for next time)
+        compiled = None
+        copying = "" if passthrough is None else ",".join(sorted(passthrough))
+        if templateCache is not None:
+            templateDigest = digestSources("template" + copying, calendarFile,
+                                           catalogueFile, rulesFile, mergeFile)
+            with timer.stage("compiled"):
+                compiled = loadTemplate(templateCache, templateDigest, self.categoryRules)
+        self.templateCacheHit = None if templateCache is None else compiled is not None
+        if compiled is not None:
+            self.header, self.template = compiled
+        else:
+            with timer.stage("calendar"):
+                cal, components, rawEvents = readCalendar(calendarFile, raw=True)
+            with timer.stage("template"):
+                self.header = calendarHeader(cal)
+                self.template = prepareTemplate(components, MergeRules.load(mergeFile),
+                                                catalogue, self.categoryRules,
+                                                rawEvents, passthrough)
+                if templateCache is not None:
+                    saveTemplate(templateCache, templateDigest, self.header, self.template)
+        
+        # Parse the placeholders now rather than racing to on first use
+        for templateEvent in self.template:
+            if templateEvent.source is not None:
+                templateEvent.component
+        
+        if sources is None:
+            sources = readSources(clinicFile, catalogue, layout, students, eventFilter,
+                                  hospitalFile, timer, seminarFile)
+        self.sources = sources
+        self.unknownClinicKeys = dict(catalogue.unknown)
+        self.sourceDigest = digestSources(
+            mode + copying + ("" if eventFilter is None else eventFilter.describe()),
+            calendarFile, rulesFile, mergeFile)
+        
+        # In shared mode everything but the clinics goes into one cohort
+        # calendar. Student calendars then only hold clinics, numbered after
+        # the cohort events so the UIDs never collide
+        self.firstUID = 0
+        if mode == "Shared":
+            self.firstUID = sum(1 for e in self.template if e.source is None)
+    
+    def iterEvents(self, studentClinicID):
+        """One student's events in calendar order, built as they are consumed
+        
+        studentClinicID (int)
+            Which student
+        returns (iterator(StudentEvent))
+            See studentEvents()
+        """
+        return studentEvents(self.template, self.sources, studentClinicID,
+                             self.mode, self.firstUID, self.eventFilter)
+    
+    def generate(self, studentClinicID, entries=None, records=None):
+        """One student's calendar
+        
+        studentClinicID (int)
+            Which student
+        entries (list) [None]
+            If given, the (UID, fingerprint) of each event is appended to it
+            (see indexCalendar())
+        records (list) [None]
+            If given, the student's JSON export records are appended to it
+            (see StudentEvent.records())
+        returns (bytes)
+            The serialized calendar
+        """
+        return b"".join(chain([self.header],
+                              serializeEvents(self.iterEvents(studentClinicID), entries,
+                                              records, self.eventFilter),
+                              [CALENDAR_FOOTER]))
+    
+    def sessionCacheStats(self):
+        """How well serialized sessions were shared between students so far
+        
+        returns (int, int)
+            (Personalized events served from the cache, events serialized)
+        """
+        misses = sum(len(e._merged) for e in self.template if e.source is not None)
+        merges = sum(e.merges for e in self.template if e.source is not None)
+        return (merges - misses, misses)
+    
+    def generateMany(self, studentClinicIDs):
+        """Several students' calendars, generated one at a time as they are
+        consumed
+        
+        studentClinicIDs (iterable(int))
+            Which students
+        yields (int, bytes)
+            (Student clinic ID, serialized calendar)
+        """
+        for studentClinicID in studentClinicIDs:
+            yield (studentClinicID, self.generate(studentClinicID))
+    
+    def cohort(self, records=None):
+        """The cohort calendar of shared mode: every event that isn't
+        personalized, numbered from 0
+        
+        records (list) [None]
+            If given, the JSON export records are appended to it
+        returns (bytes)
+            The serialized calendar
+        """
+        events = expandRecurrences(e for e in templateSource(self.template, "All",
+                                                             self.eventFilter)
+                                   if e.source is None)
+        events = assignUIDs(categorize(events))
+        return b"".join(chain([self.header],
+                              serializeEvents(events, None, records, self.eventFilter),
+                              [CALENDAR_FOOTER]))
+
+# Who the students are unless --roster says otherwise
+ROSTER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Roster.json")
+
+class Roster:
+    """Who the students are and which faculty calendar each one's calendar is
+    made from, read from a JSON list of
+        {"id": 5, "name": "...", "section": 1, "calendar": "... 1-30.ics"}
+    objects (name and section are optional). Calendars are relative to the
+    roster's folder. Clinic IDs missing from the roster (61 and 120 in
+    2020-2021) are never generated.
+    
+    Members:
+        students (dict(int: tuple(str, int, str)))
+            Student clinic ID to (name, section, faculty calendar)
+    """
+    
+    # The shared, lazily loaded default roster
+    _default = None
+    
+    def __init__(self, students, folder=""):
+        self.students = {}
+        for student in students:
+            if student["id"] in self.students:
+                raise ValueError("Student {} is on the roster more than once".format(
+                                    student["id"]))
+            self.students[student["id"]] = (student.get("name", ""),
+                                            student.get("section"),
+                                            os.path.join(folder, student["calendar"]))
+    
+    @staticmethod
+    def load(rosterFile=ROSTER_FILE):
+        """Reads a roster
+        
+        rosterFile (str)
+            JSON file to read
+        returns (Roster)
+        """
+        with open(rosterFile) as handle:
+            return Roster(json.load(handle), os.path.dirname(os.path.abspath(rosterFile)))
+    
+    @staticmethod
+    def default():
+        """The roster next to this script, loaded on first use"""
+        if Roster._default is None:
+            Roster._default = Roster.load()
+        return Roster._default
+    
+    def plan(self, calendarFile=None, first=None, last=None, unlisted=()):
+        """Groups the students to generate by faculty calendar, so that each
+        calendar is only parsed once, biggest group first so that groups
+        handed out to workers in this order keep them evenly busy
+        
+        calendarFile (str) [None]
+            Only the students made from a faculty calendar of this name
+        first, last (int) [None]
+            Only students with clinic IDs in this range
+        unlisted (iterable(int)) [()]
+            Students to make from 'calendarFile' if the roster has nobody
+            made from a calendar of that name (e.g. a synthetic cohort)
+        returns (list(tuple(str, list(int))))
+            (Faculty calendar, student clinic IDs in order) for each group
+        """
+        groups = {}
+        for (studentClinicID, (_, _, calendar)) in sorted(self.students.items()):
+            if (first is None or studentClinicID >= first) \
+                    and (last is None or studentClinicID <= last):
+                groups.setdefault(calendar, []).append(studentClinicID)
+        
+        if calendarFile is not None:
+            name = os.path.basename(calendarFile)
+            studentClinicIDs = [studentClinicID
+                                for (calendar, group) in groups.items()
+                                if os.path.basename(calendar) == name
+                                for studentClinicID in group]
+            if not any(os.path.basename(calendar) == name
+                       for (_, _, calendar) in self.students.values()):
+                studentClinicIDs = [studentClinicID for studentClinicID in unlisted
+                                    if (first is None or studentClinicID >= first)
+                                    and (last is None or studentClinicID <= last)]
+            groups = {calendarFile: studentClinicIDs} if studentClinicIDs else {}
+        return sorted(groups.items(), key=lambda group: (-len(group[1]), group[0]))
+
+class Checkpoint:
+    """Lets a batch run that died half-way be carried on with --resume
+    instead of starting over. The state folder holds
+        state.json      digest of the inputs and options of the run
+        clinics.pickle  the data sources as read from the Excel files
+        *.tplc          each faculty calendar compiled (see saveTemplate())
+        completed.log   a line per student whose files are all written
+    A resumed run whose inputs or options changed starts over. The folder
+    is emptied once the run finishes.
+    
+    Members:
+        stateDir (str)
+            The state folder
+        digest (str)
+            Digest of the run's inputs and options, see runDigest()
+    """
+    
+    def __init__(self, stateDir, digest):
+        from threading import Lock
+        
+        self.stateDir = stateDir
+        self.digest = digest
+        self._lock = Lock()
+    
+    def __getstate__(self):
+        # Worker processes get their own lock; completed.log is appended to
+        # a line at a time, which is safe across processes
+        return (self.stateDir, self.digest)
+    
+    def __setstate__(self, state):
+        self.__init__(*state)
+    
+    def _path(self, name):
+        return os.path.join(self.stateDir, name)
+    
+    def start(self, resume=False, warn=sys.stderr):
+        """Picks up the checkpoint of the same run, or clears it and starts a
+        new one
+        
+        resume (bool) [False]
+            Whether to pick it up
+        warn (file or None) [sys.stderr]
+            Where to say why it couldn't be
+        returns (set(int))
+            Students already done
+        """
+        if resume:
+            try:
+                with open(self._path("state.json")) as handle:
+                    digest = json.load(handle)["digest"]
+            except (OSError, ValueError, KeyError):
+                digest = None
+            if digest == self.digest:
+                try:
+                    with open(self._path("completed.log")) as handle:
+                        return {int(line) for line in handle if line.strip()}
+                except OSError:
+                    return set()
+            if warn is not None:
+                warn.write("warning: {} has no checkpoint of this run; starting over\n"
+                           "".format(self.stateDir))
+        
+        self.finish()
+        if not os.path.exists(self.stateDir):
+            os.makedirs(self.stateDir)
+        writeAtomic(self._path("state.json"), json.dumps({"digest": self.digest}).encode())
+        return set()
+    
+    def loadSources(self):
+        """The checkpointed data sources, or None"""
+        import pickle
+        
+        try:
+            with open(self._path("clinics.pickle"), "rb") as handle:
+                return pickle.load(handle)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+    
+    def saveSources(self, sources):
+        """Checkpoints the data sources (see readSources())"""
+        import pickle
+        
+        writeAtomic(self._path("clinics.pickle"),
+                    pickle.dumps(sources, pickle.HIGHEST_PROTOCOL))
+    
+    def templatePath(self, calendarFile):
+        """Where the compiled copy of a faculty calendar is checkpointed"""
+        return self._path(os.path.basename(calendarFile) + ".tplc")
+    
+    def completion(self, studentClinicID, parts=1):
+        """A callback recording a student as done once it has been called
+        for each of the student's 'parts' files"""
+        remaining = [parts]
+        def done():
+            with self._lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    with open(self._path("completed.log"), "a") as handle:
+                        handle.write("{}\n".format(studentClinicID))
+        return done
+    
+    def finish(self):
+        """Empties the state folder"""
+        for name in ("state.json", "clinics.pickle", "completed.log"):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        if os.path.isdir(self.stateDir):
+            for name in os.listdir(self.stateDir):
+                if name.endswith(".tplc"):
+                    os.remove(self._path(name))
+
+# Options that don't change what a run writes, left out of runDigest()
+RUN_DIGEST_IGNORED = {"jobs", "writers", "timings", "metrics", "prometheus", "state",
+                      "resume", "templateCache"}
+
+def runDigest(args, plan):
+    """Digest of everything a batch run's output depends on: its options and
+    input files
+    
+    args (argparse.Namespace)
+        Command line arguments
+    plan (list(tuple(str, list(int))))
+        See Roster.plan()
+    returns (str)
+    """
+    options = {name: value for (name, value) in sorted(vars(args).items())
+               if name not in RUN_DIGEST_IGNORED}
+    files = [args.clinicFile, args.catalogue, args.rules, args.merge]
+    files += [path for path in (args.roster, args.hospital, args.seminars, args.layout)
+              if path is not None]
+    if args.layout is not None:
+        # Workbooks of the sessions split off from the clinic Excel file
+        files += sorted({workbook for (workbook, _, _, _, _) in
+                         layoutSheets(args.clinicFile, loadLayout(args.layout))} -
+                        {args.clinicFile})
+    files += sorted(calendarFile for (calendarFile, _) in plan)
+    return digestSources(json.dumps(options, sort_keys=True, default=str), *files)
+
+def eventFilterOf(args):
+    """The EventFilter the command line arguments ask for, or None"""
+    if args.fromDate or args.toDate or args.categories or args.excludeCategories \
+            or args.clinics:
+        return EventFilter(args.fromDate, args.toDate, args.categories,
+                           args.excludeCategories or (), args.clinics)
+    return None
+
+def passthroughOf(args):
+    """The properties the command line arguments ask to pass through, or
+    None to re-encode events instead"""
+    if not args.passthrough:
+        return None
+    return PASSTHROUGH_PROPERTIES | {name.upper() for name in args.keep or ()}
+
+def cohortName(calendarFile):
+    """What the shared-mode cohort calendar and manifest of a faculty
+    calendar's students are named after: the calendar's whole name, since
+    faculty calendars of different groups tend to start with the same 25
+    characters that the students' own calendars are named after
+    
+    calendarFile (str)
+        The faculty calendar
+    returns (str)
+    """
+    return os.path.basename(calendarFile).split(".",1)[0]
+
+def generateGroup(args, calendarFile, studentClinicIDs, writer, students=None,
+                  sources=None, timer=None, checkpoint=None, completed=()):
+    """Generates the calendars of students sharing a faculty calendar and
+    hands them to 'writer'
+    
+    args (argparse.Namespace)
+        Command line arguments
+    calendarFile (str)
+        Their faculty calendar
+    studentClinicIDs (list(int))
+        Which students
+    writer (CalendarWriter)
+        Where the calendars go
+    students, sources
+        See CalendarGenerator()
+    timer (RunMetrics) [None]
+        Records how long each step took and what was generated
+    checkpoint (Checkpoint) [None]
+        Where to record each student as done
+    completed (set(int)) [()]
+        Students done by an earlier attempt at the run, which are skipped
+    returns (CalendarGenerator)
+    """
+    if timer is None:
+        timer = RunMetrics()
+    mode = args.mode
+    outputDir = args.outputDir
+    layout = None if args.layout is None else loadLayout(args.layout)
+    templateCache = args.templateCache
+    if templateCache is None and checkpoint is not None:
+        templateCache = checkpoint.templatePath(calendarFile)
+    generator = CalendarGenerator(args.clinicFile, calendarFile, mode, args.catalogue,
+                                  args.rules, args.merge, args.hospital,
+                                  templateCache, layout,
+                                  studentClinicIDs if students is None else students,
+                                  sources, eventFilterOf(args), timer,
+                                  passthroughOf(args), args.seminars)
+    
+    outputPrefix = os.path.basename(calendarFile).split(".",1)[0][:25]
+    cohortPrefix = cohortName(calendarFile)
+    exportHeader = {"calendar": os.path.basename(calendarFile),
+                    "source": generator.sourceDigest, "timezone": EASTERN.key}
+    with timer.stage("generate"):
+        if mode == "Shared":
+            manifest = {
+                "cohort": "{} - Cohort.ics".format(cohortPrefix),
+                "students": {}
+            }
+            records = None if args.export is None else []
+            writer.writeData(manifest["cohort"], generator.cohort(records))
+            if records is not None:
+                writer.writeExport("{} - Cohort{}".format(cohortPrefix, args.export),
+                                   dict(exportHeader, student=None), records, args.export)
+        
+        # Create a calendar for each student
+        for studentClinicID in studentClinicIDs:
+            outputFile = "{} - {}.ics".format(outputPrefix, studentClinicID)
+            exportFile = None
+            if args.export is not None:
+                exportFile = "{} - {}{}".format(outputPrefix, studentClinicID, args.export)
+            if mode == "Shared":
+                manifest["students"][str(studentClinicID)] = {
+                    "cohort": manifest["cohort"],
+                    "clinics": outputFile
+                }
+                if exportFile is not None:
+                    manifest["students"][str(studentClinicID)]["export"] = exportFile
+            if studentClinicID in completed:
+                timer.count("studentsResumed")
+                continue
+            done = None
+            if checkpoint is not None:
+                done = checkpoint.completion(studentClinicID, 1 if exportFile is None else 2)
+            
+            # Try to only rewrite what changed since the last run (unless its
+            # export has yet to be written)
+            if args.patch and (exportFile is None
+                               or os.path.exists(os.path.join(outputDir, exportFile))):
+                changed = patchCalendar(os.path.join(outputDir, outputFile),
+                                        generator.iterEvents(studentClinicID),
+                                        generator.sourceDigest)
+                if changed is not None:
+                    timer.count("studentsPatched" if changed else "studentsUnchanged")
+                    timer.count("eventsPatched", changed)
+                    if checkpoint is not None:
+                        checkpoint.completion(studentClinicID)()
+                    continue
+            
+            # Hand the calendar (and its export, made in the same pass) off
+            # to be written
+            records = None if args.export is None else []
+            if args.index or args.patch:
+                entries = []
+                data = generator.generate(studentClinicID, entries, records)
+                writer.writeData(outputFile, data, (generator.sourceDigest, entries), done)
+            else:
+                data = generator.generate(studentClinicID, records=records)
+                writer.writeData(outputFile, data, done=done)
+            if records is not None:
+                writer.writeExport(exportFile, dict(exportHeader, student=studentClinicID),
+                                   records, args.export, done)
+            timer.count("studentsGenerated")
+            timer.calendar(data)
+        
+        if mode == "Shared":
+            writer.writeData("{} - Manifest.json".format(cohortPrefix),
+                             json.dumps(manifest, indent=2).encode())
+    
+    if generator.templateCacheHit is not None:
+        timer.count("templateCacheHits" if generator.templateCacheHit
+                    else "templateCacheMisses")
+    hits, misses = generator.sessionCacheStats()
+    timer.count("sessionCacheHits", hits)
+    timer.count("sessionCacheMisses", misses)
+    timer.uncategorizedSummaries |= generator.categoryRules.uncategorized
+    for (clinicKey, amount) in generator.unknownClinicKeys.items():
+        timer.unknownClinicKeys[clinicKey] = \
+            timer.unknownClinicKeys.get(clinicKey, 0) + amount
+    return generator
+
+def generateGroupAlone(args, calendarFile, studentClinicIDs, sources=None,
+                       checkpoint=None, completed=()):
+    """generateGroup() in a worker process of its own, with its own writer
+    
+    returns (RunMetrics)
+        How long each stage took and what was generated
+    """
+    timer = RunMetrics()
+    with CalendarWriter(args.outputDir, args.writers) as writer:
+        generateGroup(args, calendarFile, studentClinicIDs, writer, sources=sources,
+                      timer=timer, checkpoint=checkpoint, completed=completed)
+    return timer
+
+def main(args, timer=None):
+    if timer is None:
+        timer = RunMetrics()
+    
+    # Without a roster the calendar named is made for everyone in -s/-e
+    roster = Roster([]) if args.roster is None else Roster.load(args.roster)
+    plan = roster.plan(args.calendarFile, args.start, args.end,
+                       layoutStudents(None if args.layout is None else loadLayout(args.layout)))
+    everyone = [studentClinicID for (_, group) in plan for studentClinicID in group]
+    if args.mode == "Shared":
+        names = {}
+        for (calendarFile, _) in plan:
+            other = names.setdefault(cohortName(calendarFile), calendarFile)
+            if other != calendarFile:
+                raise ValueError("{} and {} would write the same cohort calendar and "
+                                 "manifest".format(other, calendarFile))
+    
+    # Pick up where a failed attempt left off, reading the Excel files up
+    # front so that their parse is checkpointed too
+    checkpoint = None
+    completed = set()
+    sources = None
+    if args.state is not None:
+        checkpoint = Checkpoint(args.state, runDigest(args, plan))
+        completed = checkpoint.start(args.resume)
+        if args.resume:
+            sources = checkpoint.loadSources()
+        if sources is None:
+            catalogue = ClinicCatalogue.load(args.catalogue)
+            layout = None if args.layout is None else loadLayout(args.layout)
+            sources = readSources(args.clinicFile, catalogue, layout, everyone,
+                                  eventFilterOf(args), args.hospital, timer, args.seminars)
+            for (clinicKey, amount) in catalogue.unknown.items():
+                timer.unknownClinicKeys[clinicKey] = amount
+            checkpoint.saveSources(sources)
+        
+        # Groups with nobody left only matter for the shared manifest
+        if args.mode != "Shared":
+            plan = [(calendarFile, studentClinicIDs)
+                    for (calendarFile, studentClinicIDs) in plan
+                    if not completed.issuperset(studentClinicIDs)]
+    
+    # Groups are big enough that a process each beats sharing the Excel file
+    if args.jobs > 1 and len(plan) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        
+        with ProcessPoolExecutor(min(args.jobs, len(plan))) as pool:
+            futures = [pool.submit(generateGroupAlone, args, calendarFile, studentClinicIDs,
+                                   sources, checkpoint, completed)
+                       for (calendarFile, studentClinicIDs) in plan]
+            for future in futures:
+                timer.update(future.result())
+    else:
+        if args.archive is not None:
+            writer = ArchiveWriter(args.archive, args.compression)
+        else:
+            writer = CalendarWriter(args.outputDir, args.writers)
+        
+        # Read everyone's sessions with the first group and share them
+        with writer:
+            for (calendarFile, studentClinicIDs) in plan:
+                generator = generateGroup(args, calendarFile, studentClinicIDs, writer,
+                                          everyone, sources, timer, checkpoint, completed)
+                sources = generator.sources
+    
+    # Once for the whole run, however many faculty calendars hit the summary
+    CategoryRules.report(timer.uncategorizedSummaries)
+    if checkpoint is not None:
+        checkpoint.finish()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    
+    # Add positional arguments
+    parser.add_argument("clinicFile",
+                        metavar="<clinic.xlsx>",
+                        action=CheckFileAction,
+                        help="""Excel file containing clinic data""")
+    parser.add_argument("calendarFile",
+                        metavar="<calendar.ics>",
+                        nargs="?",
+                        action=CheckFileAction,
+                        help="""Microsoft Calendar .ics file containing class
+                            schedule; if left out, every faculty calendar on the
+                            roster""")
+                            
+    # Add optional arguments
+    parser.add_argument("-o", "--outputDir",
+                        metavar="DIR",
+                        default="Dental Calendars",
+                        help="""Output directory to store new .ics files
+                            [Dental Calendars/]""")
+    parser.add_argument("-s", "--start",
+                        metavar="int",
+                        type=int,
+                        help="""Starting student clinic ID number""")
+    parser.add_argument("-e", "--end",
+                        metavar="int",
+                        type=int,
+                        help="""Ending student clinic ID number""")
+    parser.add_argument("-R", "--roster",
+                        metavar="FILE",
+                        action=CheckFileAction,
+                        default=ROSTER_FILE,
+                        help="""JSON list of students and their faculty
+                            calendars [Roster.json]; without one,
+                            <calendar.ics> is made for everyone in -s/-e""")
+    parser.add_argument("-m", "--mode",
+                        metavar="[All,Clinics,Shared]",
+                        action=CheckModeAction,
+                        default="All",
+                        help="""All: Full calendar generated. Clinics: Just
+                            clinics generated. Shared: One cohort calendar of
+                            everything but clinics, just clinics per student,
+                            and a manifest linking the two""")
+    parser.add_argument("--from",
+                        dest="fromDate",
+                        metavar="YYYY-MM-DD",
+                        type=date.fromisoformat,
+                        help="""Leave out events that are over before this day""")
+    parser.add_argument("--to",
+                        dest="toDate",
+                        metavar="YYYY-MM-DD",
+                        type=date.fromisoformat,
+                        help="""Leave out events that start after this day""")
+    parser.add_argument("-C", "--categories",
+                        metavar="CATEGORY,...",
+                        type=commaList,
+                        help="""Only events of these colour categories, e.g.
+                            "Orange Category,Blue Category" for clinics and
+                            exams""")
+    parser.add_argument("-X", "--excludeCategories",
+                        metavar="CATEGORY,...",
+                        type=commaList,
+                        help="""No events of these colour categories""")
+    parser.add_argument("-K", "--clinics",
+                        metavar="KEY,...",
+                        type=commaList,
+                        help="""Only clinic sessions with these keys from the
+                            Excel file (see ClinicCatalogue.json)""")
+    parser.add_argument("-j", "--jobs",
+                        metavar="int",
+                        type=int,
+                        default=1,
+                        help="""Number of processes, each generating the
+                            students of one faculty calendar at a time [1]""")
+    parser.add_argument("-w", "--writers",
+                        metavar="int",
+                        type=int,
+                        default=4,
+                        help="""Number of threads writing output files; 0 writes
+                            them one at a time [4]""")
+    parser.add_argument("-H", "--hospital",
+                        metavar="FILE",
+                        action=CheckFileAction,
+                        help="""Excel file of hospital rotations (Student, Date,
+                            Slot, Site[, Details]) giving the site of each
+                            hospital rotation session""")
+    parser.add_argument("-S", "--seminars",
+                        metavar="FILE",
+                        action=CheckFileAction,
+                        help="""Excel file of the students' seminar rooms
+                            (Student, Clinic, Room[, Date, Details]) giving
+                            the room of seminars the catalogue leaves to the
+                            course syllabus""")
+    parser.add_argument("-L", "--layout",
+                        metavar="FILE",
+                        action=CheckFileAction,
+                        help="""JSON layout of <clinic.xlsx> if it isn't the
+                            2020-2021 one (see SyntheticCohort.py)""")
+    parser.add_argument("-c", "--catalogue",
+                        metavar="FILE",
+                        action=CheckFileAction,
+                        default=CLINIC_CATALOGUE_FILE,
+                        help="""JSON catalogue of clinic keys
+                            [ClinicCatalogue.json]""")
+    parser.add_argument("-r", "--rules",
+                        metavar="FILE",
+                        action=CheckFileAction,
+                        default=CATEGORY_RULES_FILE,
+                        help="""JSON rules colouring non-clinic events
+                            [CategoryRules.json]""")
+    parser.add_argument("--merge",
+                        metavar="FILE",
+                        action=CheckFileAction,
+                        default=MERGE_RULES_FILE,
+                        help="""JSON rules saying which events are personalized
+                            from which data [MergeRules.json]""")
+    parser.add_argument("-T", "--templateCache",
+                        metavar="FILE",
+                        help="""Compiled copy of <calendar.ics> to start from
+                            instead of parsing it; (re)compiled whenever it is
+                            missing or any of its sources changed""")
+    parser.add_argument("-P", "--passthrough",
+                        action="store_true",
+                        help="""Copy events that aren't personalized from
+                            <calendar.ics> as they are, keeping only standard
+                            properties, instead of re-encoding them""")
+    parser.add_argument("--keep",
+                        metavar="NAME,...",
+                        type=commaList,
+                        help="""More properties or subcomponents for
+                            --passthrough to keep, e.g. X-ALT-DESC,VALARM""")
+    parser.add_argument("-a", "--archive",
+                        metavar="FILE",
+                        action=CheckArchiveAction,
+                        help="""Write every calendar into this single .zip or
+                            .tar.gz archive instead of into DIR""")
+    parser.add_argument("-z", "--compression",
+                        metavar="int",
+                        type=int,
+                        action=CheckLevelAction,
+                        default=6,
+                        help="""Compression level for --archive, 0-9 [6]""")
+    parser.add_argument("-J", "--export",
+                        metavar="EXT",
+                        choices=sorted(EXPORT_FORMATS),
+                        help="""Also write each calendar as a JSON event list
+                            for web and mobile clients: .json, .jsonl (JSON
+                            lines), either plus .gz, or plus .br (needs
+                            brotli)""")
+    parser.add_argument("-i", "--index",
+                        action="store_true",
+                        help="""Also write a .idx file next to each calendar so
+                            that later runs can --patch it""")
+    parser.add_argument("-p", "--patch",
+                        action="store_true",
+                        help="""Only rewrite the events that changed in
+                            calendars written with --index (implies --index)""")
+    parser.add_argument("--metrics",
+                        metavar="FILE",
+                        help="""Append a JSON line of this run's timings,
+                            counts and data problems to FILE""")
+    parser.add_argument("--prometheus",
+                        metavar="FILE",
+                        help="""Write the same as Prometheus metrics to FILE
+                            (e.g. for the node exporter's textfile collector)""")
+    parser.add_argument("--state",
+                        metavar="DIR",
+                        help="""Checkpoint the run in DIR (the parsed inputs
+                            and which students are done) so that it can be
+                            resumed if it fails""")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="""Carry on from the checkpoint in --state DIR,
+                            skipping the students already done""")
+    parser.add_argument("-t", "--timings",
+                        action="store_true",
+                        help="""Print how long startup and each stage took""")
+    args = parser.parse_intermixed_args()
+    if args.archive is not None and (args.index or args.patch):
+        parser.error("--index and --patch only work with an output directory")
+    if args.archive is not None and args.jobs > 1:
+        parser.error("--jobs only works with an output directory")
+    if args.archive is not None and args.state is not None:
+        parser.error("--state only works with an output directory")
+    if args.resume and args.state is None:
+        parser.error("--resume needs --state DIR")
+    if not os.path.exists(args.roster):
+        if args.calendarFile is None:
+            parser.error("<calendar.ics> is needed without a roster ({} not found)".format(
+                            args.roster))
+        args.roster = None
+    if args.keep and not args.passthrough:
+        parser.error("--keep needs --passthrough")
+    if args.export is not None and EXPORT_FORMATS[args.export][1] == "brotli":
+        try:
+            import brotli
+        except ImportError:
+            parser.error("--export {} needs the brotli module".format(args.export))
+    timer = RunMetrics()
+    timer.stages.append(("startup", perf_counter() - _MODULE_START))
+    try:
+        main(args, timer)
+    except Exception as e:
+        timer.error = "{}: {}".format(type(e).__name__, e)
+        raise
+    finally:
+        if args.metrics is not None:
+            timer.writeJSONLines(args.metrics)
+        if args.prometheus is not None:
+            timer.writePrometheus(args.prometheus)
+    if args.timings:
+        timer.report()
@@ -1,6 +1,4 @@
 #!/bin/bash
 
-python3 DentalCalendar2020.py -s 1 -e 30 DDS4\ Clinical\ 2020-2021\ \(Dec\ 18\).xlsx DDS\ IV\ 2020-2021\ Calendar\ 1-30.ics
-python3 DentalCalendar2020.py -s 31 -e 60 DDS4\ Clinical\ 2020-2021\ \(Dec\ 18\).xlsx DDS\ IV\ 2020-2021\ Calendar\ 31-60.ics
-python3 DentalCalendar2020.py -s 61 -e 90 DDS4\ Clinical\ 2020-2021\ \(Dec\ 18\).xlsx DDS\ IV\ 2020-2021\ Calendar\ 62-90.ics
-python3 DentalCalendar2020.py -s 91 -e 120 DDS4\ Clinical\ 2020-2021\ \(Dec\ 18\).xlsx DDS\ IV\ 2020-2021\ Calendar\ 91-119.ics
\ No newline at end of file
+# Every student on Roster.json, each faculty calendar parsed once
+python3 DentalCalendar2020.py DDS4\ Clinical\ 2020-2021\ \(Dec\ 18\).xlsx
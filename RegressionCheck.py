@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# RegressionCheck.py - Regenerates the calendars in "Dental Calendars/" from
+# the faculty calendars in this folder and checks that nothing changed, so
+# that refactoring DentalCalendar2020.py can be done without fear.
+#
+# The clinic Excel file those calendars were made from isn't public, so one is
+# reconstructed from the calendars themselves: every personalized event says
+# which clinic a student was in at what time, and the catalogue says which
+# key that was. That makes the clinic sessions themselves a round trip, but
+# everything else (template handling, recurrences, skipped sessions, colours,
+# UIDs, times and DST) is checked for real.
+#
+# Calendars are compared event by event (matched on UID), ignoring the order
+# of events and properties, DTSTAMP, quoting of parameters and the default
+# VALUE=DATE-TIME.
+#
+# The whole roster is also generated in --mode Shared, checking that every
+# faculty calendar gets a cohort calendar and manifest of its own even though
+# their names start alike.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+import glob
+import os
+import json
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import DentalCalendar2020 as dc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# First Monday of every week in the 2020-2021 clinic Excel file, in the order
+# of clinicLayout()'s week blocks
+WEEKS = [date(2020, 9, 7) + timedelta(weeks=i) for i in range(15)] \
+      + [date(2021, 1, 4) + timedelta(weeks=i) for i in range(8)] \
+      + [date(2021, 3, 8) + timedelta(weeks=i) for i in range(9)] \
+      + [date(2021, 5, 10)]
+
+# Key for the sessions no calendar mentions. Left-out 4:30 sessions were study
+# or faculty time, and nothing else is ever looked at
+FILLER_KEY = "FT"
+
+# Names of the weekdays in the Excel file
+WEEKDAY_NAMES = {number: name for (name, number) in dc.WEEKDAYS.items()}
+
+def sessionRows():
+    """The date and slot of every session row in clinicLayout()
+    
+    returns (dict(int: tuple(date, str)))
+        (Date, "AM"/"PM"/"PM1"/"PM2") by dataframe row
+    """
+    rows = {}
+    sessions, _ = dc.clinicLayout()
+    
+    # Sessions come a week at a time: 4 rows a day (AM, PM1, PM2 and a blank
+    # one) except for the last week (AM, PM and a blank one), and Friday only
+    # has AM and PM until Christmas
+    week = -1
+    previous = None
+    for row in sessions:
+        if previous is None or row - previous > 4:
+            week += 1
+            weekStart = row
+        previous = row
+        offset = row - weekStart
+        if WEEKS[week] == WEEKS[-1]:
+            day, slot = divmod(offset, 3)
+            name = ["AM", "PM"][slot]
+        else:
+            day, slot = divmod(offset, 4)
+            name = ["AM", "PM1", "PM2"][slot]
+            if week < 15 and day == dc.FRIDAY:
+                name = ["AM", "PM"][slot]
+        rows[row] = (WEEKS[week] + timedelta(days=day), name)
+    return rows
+
+def columnNumber(name):
+    """0-based Excel column of a dataframe column from clinicLayout()"""
+    match = re.match(r"Unnamed: (\d+)$", name)
+    return int(match.group(1)) if match else None
+
+def unfoldLines(text):
+    """The content lines of a .ics file with folding undone"""
+    return re.sub(r"\r?\n[ \t]", "", text).splitlines()
+
+def parseLine(line):
+    """Splits a content line into its name, parameters and value
+    
+    returns (str, tuple(tuple(str, str)), str)
+    """
+    match = re.match(r'([^:;]+)((?:;[^=;:]+=(?:"[^"]*"|[^";:]*))*):(.*)$', line)
+    name, params, value = match.groups()
+    params = tuple(sorted((k.upper(), v.strip('"')) for (k, v) in
+                          re.findall(r';([^=;:]+)=("[^"]*"|[^";:]*)', params)
+                          if (k.upper(), v) != ("VALUE", "DATE-TIME")))
+    return (name.upper(), params, value)
+
+def unescape(value):
+    """The text of an escaped TEXT value"""
+    return re.sub(r"\\([\\;,nN])",
+                  lambda m: "\n" if m.group(1) in "nN" else m.group(1), value)
+
+def readEvents(path):
+    """Every event of a calendar file, see parseEvents()"""
+    with open(path, newline="") as handle:
+        return parseEvents(handle.read())
+
+def parseEvents(text):
+    """Every event of a calendar, for comparing
+    
+    text (str)
+        The calendar
+    returns (dict(str: list(tuple(str, tuple, str))))
+        Sorted content lines of each event (DTSTAMP left out) by UID
+    """
+    events = {}
+    event = None
+    for line in unfoldLines(text):
+        if line == "BEGIN:VEVENT":
+            event = []
+        elif line == "END:VEVENT":
+            uid = next(value for (name, _, value) in event if name == "UID")
+            events[uid] = sorted(event)
+            event = None
+        elif event is not None:
+            parsed = parseLine(line)
+            if parsed[0] != "DTSTAMP":
+                event.append(parsed)
+    return events
+
+def compareCalendars(goldenPath, data):
+    """Differences between a golden calendar and a regenerated one
+    
+    goldenPath (str)
+        The golden .ics file
+    data (bytes)
+        The regenerated calendar
+    returns (list(str))
+        One line per difference, empty if they match
+    """
+    golden = readEvents(goldenPath)
+    new = parseEvents(data.decode())
+    
+    diffs = []
+    for uid in sorted(golden.keys() - new.keys()):
+        diffs.append("missing {}".format(uid))
+    for uid in sorted(new.keys() - golden.keys()):
+        diffs.append("extra   {}".format(uid))
+    for uid in sorted(golden.keys() & new.keys()):
+        if golden[uid] == new[uid]:
+            continue
+        old = {(name, params): value for (name, params, value) in golden[uid]}
+        now = {(name, params): value for (name, params, value) in new[uid]}
+        for key in sorted(old.keys() | now.keys()):
+            if old.get(key) != now.get(key):
+                diffs.append("changed {} {}: {!r} -> {!r}".format(
+                    uid, key[0], old.get(key), now.get(key)))
+    return diffs
+
+def reconstructWorkbook(goldenDir, workbookPath, catalogue=None):
+    """Writes a clinic Excel file that reproduces the golden calendars
+    
+    goldenDir (str)
+        Folder of golden calendars ("... - <student>.ics")
+    workbookPath (str)
+        Where to write the .xlsx file
+    catalogue (ClinicCatalogue) [ClinicCatalogue.default()]
+        What the clinic keys mean
+    """
+    from openpyxl import Workbook
+    
+    if catalogue is None:
+        catalogue = dc.ClinicCatalogue.default()
+    rows = sessionRows()
+    rowsByDate = {}
+    for (row, (day, slot)) in rows.items():
+        rowsByDate.setdefault(day, []).append((row, slot))
+    _, columns = dc.clinicLayout()
+    # A group's "Section" column comes right before its first unnamed one
+    numbers = [columnNumber(name) for name in columns]
+    numbers = [n if n is not None else numbers[i + 1] - 1 for (i, n) in enumerate(numbers)]
+    keysBySummary = {}
+    for (key, summary) in catalogue.summaries.items():
+        keysBySummary.setdefault(summary, []).append(key)
+    
+    grid = {}
+    for path in glob.glob(os.path.join(goldenDir, "*.ics")):
+        studentClinicID = int(re.search(r"- (\d+)\.ics$", path).group(1))
+        for event in readEvents(path).values():
+            properties = {name: (params, value) for (name, params, value) in event}
+            params, value = properties["DTSTART"]
+            # Personalized events are the only ones written in this timezone
+            if dict(params).get("TZID") != dc.EASTERN.key:
+                continue
+            start = datetime.strptime(value, "%Y%m%dT%H%M%S")
+            summary = unescape(properties["SUMMARY"][1])
+            details = tuple(unescape(properties[name][1]) if name in properties else ""
+                            for name in ("LOCATION", "DESCRIPTION", "CATEGORIES"))
+            
+            # Later rows win when several match, just like in readClinicData()
+            for (row, slot) in sorted(rowsByDate[start.date()], reverse=True):
+                keys = [key for key in keysBySummary.get(summary, [summary])
+                        if catalogue.lookup(key, start.weekday(), start.hour >= 12)[1:] == details
+                        and dc.getStartTime(start.month, start.day, slot, start.weekday(),
+                                            studentClinicID, key) == (start.hour, start.minute)]
+                if keys:
+                    grid[(row, studentClinicID)] = keys[-1]
+                    break
+            else:
+                raise ValueError("{}: no clinic key reproduces '{}' at {}".format(
+                    path, summary, start))
+    
+    workbook = Workbook()
+    sheet = workbook.active
+    # pandas names the columns after the header row
+    for (name, number) in zip(columns, numbers):
+        if columnNumber(name) is None:
+            sheet.cell(1, number + 1, "Section")
+    for (row, (day, slot)) in rows.items():
+        sheet.cell(row + 2, 1, WEEKDAY_NAMES[day.weekday()])
+        sheet.cell(row + 2, 2, datetime(day.year, day.month, day.day))
+        sheet.cell(row + 2, 3, slot)
+        for (studentClinicID, number) in enumerate(numbers, 1):
+            sheet.cell(row + 2, number + 1, grid.get((row, studentClinicID), FILLER_KEY))
+    workbook.save(workbookPath)
+
+def checkTemplate(workbookPath, calendarFile, goldenDir, studentClinicIDs):
+    """Regenerates the students of one faculty calendar and compares them
+    
+    workbookPath (str)
+        Clinic Excel file
+    calendarFile (str)
+        Faculty calendar
+    goldenDir (str)
+        Folder of golden calendars
+    studentClinicIDs (list(int))
+        Students whose golden calendar was made from this faculty calendar
+    returns (list(tuple(int, list(str))))
+        (Student clinic ID, differences) for each student
+    """
+    generator = dc.CalendarGenerator(workbookPath, calendarFile)
+    prefix = os.path.basename(calendarFile).split(".", 1)[0][:25]
+    results = []
+    for (studentClinicID, data) in generator.generateMany(studentClinicIDs):
+        goldenPath = os.path.join(goldenDir, "{} - {}.ics".format(prefix, studentClinicID))
+        results.append((studentClinicID, compareCalendars(goldenPath, data)))
+    return results
+
+def checkShared(workbookPath, plan):
+    """Generates every calendar on the roster in shared mode and checks that
+    each faculty calendar's cohort calendar and manifest survive the run,
+    list just its students, and share no UID with their clinic calendars
+    
+    workbookPath (str)
+        Clinic Excel file
+    plan (list(tuple(str, list(int))))
+        See Roster.plan()
+    returns (list(str))
+        One line per problem, empty if there are none
+    """
+    outputDir = tempfile.mkdtemp()
+    try:
+        subprocess.run([sys.executable, os.path.join(HERE, "DentalCalendar2020.py"),
+                        workbookPath, "-m", "Shared", "-o", outputDir],
+                       check=True, stderr=subprocess.DEVNULL)
+        
+        problems = []
+        for (calendarFile, studentClinicIDs) in plan:
+            name = dc.cohortName(calendarFile)
+            manifestPath = os.path.join(outputDir, "{} - Manifest.json".format(name))
+            cohortPath = os.path.join(outputDir, "{} - Cohort.ics".format(name))
+            if not os.path.exists(manifestPath) or not os.path.exists(cohortPath):
+                problems.append("{}: no cohort calendar or manifest".format(name))
+                continue
+            with open(manifestPath) as handle:
+                manifest = json.load(handle)
+            listed = sorted(int(student) for student in manifest["students"])
+            if listed != sorted(studentClinicIDs):
+                problems.append("{}: manifest lists students {}".format(name, listed))
+            cohortUIDs = set(readEvents(cohortPath))
+            for (student, files) in sorted(manifest["students"].items()):
+                if files["cohort"] != os.path.basename(cohortPath):
+                    problems.append("{}: student {} points to {}".format(
+                        name, student, files["cohort"]))
+                shared = cohortUIDs & set(readEvents(os.path.join(outputDir,
+                                                                  files["clinics"])))
+                if shared:
+                    problems.append("{}: student {} shares {} UID(s) with the cohort "
+                                    "calendar".format(name, student, len(shared)))
+        return problems
+    finally:
+        shutil.rmtree(outputDir)
+
+def main(args):
+    goldenDir = args.goldenDir
+    plan = dc.Roster.default().plan()
+    
+    workbookPath = args.workbook
+    temporary = None
+    if workbookPath is None:
+        temporary = tempfile.mkdtemp()
+        workbookPath = os.path.join(temporary, "clinic.xlsx")
+        reconstructWorkbook(goldenDir, workbookPath)
+    
+    try:
+        with ProcessPoolExecutor(args.jobs) as pool:
+            futures = [pool.submit(checkTemplate, workbookPath, calendarFile, goldenDir,
+                                   studentClinicIDs)
+                       for (calendarFile, studentClinicIDs) in plan]
+            results = sorted(r for future in futures for r in future.result())
+        sharedProblems = checkShared(workbookPath, plan)
+    finally:
+        if temporary is not None:
+            os.remove(workbookPath)
+            os.rmdir(temporary)
+    
+    bad = 0
+    for (studentClinicID, diffs) in results:
+        if not diffs:
+            continue
+        bad += 1
+        print("student {}: {} difference(s)".format(studentClinicID, len(diffs)))
+        for diff in diffs[:args.limit]:
+            print("  " + diff)
+        if len(diffs) > args.limit:
+            print("  ...")
+    print("{} calendars checked, {} differ".format(len(results), bad))
+    for problem in sharedProblems:
+        print("shared mode: " + problem)
+    print("shared mode: {} faculty calendars checked, {} problem(s)".format(
+        len(plan), len(sharedProblems)))
+    return 1 if bad or sharedProblems else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""Regenerates every calendar
+        in the golden folder and compares it with the committed one""")
+    parser.add_argument("-g", "--goldenDir",
+                        metavar="DIR",
+                        default=os.path.join(HERE, "Dental Calendars"),
+                        help="""Folder of golden calendars [Dental Calendars/]""")
+    parser.add_argument("-x", "--workbook",
+                        metavar="FILE",
+                        help="""Clinic Excel file to use instead of
+                            reconstructing one from the golden calendars""")
+    parser.add_argument("-j", "--jobs",
+                        metavar="int",
+                        type=int,
+                        default=os.cpu_count(),
+                        help="""Number of processes [all CPUs]""")
+    parser.add_argument("-l", "--limit",
+                        metavar="int",
+                        type=int,
+                        default=10,
+                        help="""Differences shown per student [10]""")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# ScalingBenchmark.py - Times DentalCalendar2020.py on synthetic cohorts of
+# growing size (see SyntheticCohort.py) and reports how the run time and
+# memory grow with the number of students.
+#
+# Each size is generated into a temporary folder and then run in a fresh
+# process, so that peak memory is that size's alone. Results are printed as a
+# table, and optionally written as CSV and plotted (needs matplotlib).
+#
+#   python3 ScalingBenchmark.py -n 60,120,250,500 -w 33,66 --plot scaling.png
+
+import argparse
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import SyntheticCohort
+
+# What is reported for each run, in order
+FIELDS = ["students", "weeks", "events", "load", "generate", "total", "peakMB"]
+
+def peakMemoryMB():
+    """Peak resident memory of this process in MB, or None if unknown"""
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def runCohort(cohortDir):
+    """Generates every calendar of a cohort written by SyntheticCohort.py,
+    keeping nothing but their sizes
+    
+    cohortDir (str)
+        The cohort's folder
+    returns (dict)
+        Number of events, seconds spent loading and generating, and peak
+        memory in MB
+    """
+    import DentalCalendar2020 as dc
+    
+    with open(os.path.join(cohortDir, "cohort.json")) as handle:
+        cohort = json.load(handle)
+    layout = dc.loadLayout(cohort["layout"])
+    
+    # The Excel file is read once with the first group, like main() does
+    students = [student for (_, first, last) in cohort["templates"]
+                for student in range(first, last + 1)]
+    sources = None
+    load = generate = 0.0
+    events = 0
+    for (calendarFile, first, last) in cohort["templates"]:
+        start = perf_counter()
+        generator = dc.CalendarGenerator(cohort["workbook"], calendarFile, layout=layout,
+                                         students=students, sources=sources)
+        sources = generator.sources
+        load += perf_counter() - start
+        
+        start = perf_counter()
+        for (_, data) in generator.generateMany(range(first, last + 1)):
+            events += data.count(b"BEGIN:VEVENT")
+        generate += perf_counter() - start
+    return {"events": events, "load": load, "generate": generate,
+            "total": load + generate, "peakMB": peakMemoryMB()}
+
+def benchmark(students, weeks, sessionsPerDay=3):
+    """Writes a synthetic cohort and times it in a fresh process
+    
+    students, weeks, sessionsPerDay (int)
+        See SyntheticCohort.writeCohort()
+    returns (dict)
+        See runCohort(), plus students and weeks
+    """
+    cohortDir = tempfile.mkdtemp()
+    try:
+        workbook, layout, templates = SyntheticCohort.writeCohort(
+            cohortDir, students, weeks, sessionsPerDay)
+        with open(os.path.join(cohortDir, "cohort.json"), "w") as handle:
+            json.dump({"workbook": workbook, "layout": layout, "templates": templates},
+                      handle)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__),
+                                 "--run", cohortDir],
+                                check=True, stdout=subprocess.PIPE).stdout
+    finally:
+        shutil.rmtree(cohortDir)
+    result = json.loads(output)
+    result.update(students=students, weeks=weeks)
+    return result
+
+def plotResults(results, path):
+    """Plots run time and peak memory against cohort size, a line per number
+    of weeks
+    
+    results (list(dict))
+        See benchmark()
+    path (str)
+        Image file to save
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot
+    
+    figure, (timeAxes, memoryAxes) = pyplot.subplots(1, 2, figsize=(11, 4.5))
+    for weeks in sorted({r["weeks"] for r in results}):
+        rows = sorted((r for r in results if r["weeks"] == weeks), key=lambda r: r["students"])
+        students = [r["students"] for r in rows]
+        timeAxes.plot(students, [r["total"] for r in rows], "o-",
+                      label="{} weeks".format(weeks))
+        if all(r["peakMB"] is not None for r in rows):
+            memoryAxes.plot(students, [r["peakMB"] for r in rows], "o-",
+                            label="{} weeks".format(weeks))
+    timeAxes.set(xlabel="Students", ylabel="Seconds", title="Run time")
+    memoryAxes.set(xlabel="Students", ylabel="MB", title="Peak memory")
+    for axes in (timeAxes, memoryAxes):
+        axes.grid(True)
+        axes.legend()
+    figure.tight_layout()
+    figure.savefig(path)
+
+def intList(text):
+    """argparse type for comma-separated integers"""
+    return [int(value) for value in text.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""Times calendar generation
+        for synthetic cohorts of several sizes""")
+    parser.add_argument("-n", "--students",
+                        metavar="int,...",
+                        type=intList,
+                        default=[30, 60, 120, 250, 500],
+                        help="""Cohort sizes [30,60,120,250,500]""")
+    parser.add_argument("-w", "--weeks",
+                        metavar="int,...",
+                        type=intList,
+                        default=[33],
+                        help="""Numbers of weeks (33 is about a year) [33]""")
+    parser.add_argument("-d", "--sessions",
+                        metavar="int",
+                        type=int,
+                        choices=[1, 2, 3],
+                        default=3,
+                        help="""Sessions a day [3]""")
+    parser.add_argument("--csv",
+                        metavar="FILE",
+                        help="""Also write the results as CSV""")
+    parser.add_argument("--plot",
+                        metavar="FILE",
+                        help="""Also plot the results (needs matplotlib)""")
+    parser.add_argument("--run",
+                        metavar="DIR",
+                        help=argparse.SUPPRESS) # Internal: measure one cohort
+    args = parser.parse_args()
+    
+    if args.run is not None:
+        print(json.dumps(runCohort(args.run)))
+        sys.exit(0)
+    
+    results = []
+    print("{:>8} {:>6} {:>9} {:>8} {:>9} {:>8} {:>8}".format(*FIELDS))
+    for weeks in args.weeks:
+        for students in args.students:
+            result = benchmark(students, weeks, args.sessions)
+            results.append(result)
+            print("{students:>8} {weeks:>6} {events:>9} {load:>8.2f} {generate:>9.2f} "
+                  "{total:>8.2f} {peak:>8}".format(
+                      peak="?" if result["peakMB"] is None else "{:.0f}".format(result["peakMB"]),
+                      **result), flush=True)
+    
+    if args.csv is not None:
+        with open(args.csv, "w", newline="") as handle:
+            writer = csv.DictWriter(handle, FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+    if args.plot is not None:
+        plotResults(results, args.plot)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# SyntheticCohort.py - Makes up a cohort of any size for seeing how
+# DentalCalendar2020.py copes with more students, weeks and clinics than the
+# real 2020-2021 files have.
+#
+# Writes a clinic Excel file laid out like the real one (Day, Date and Time
+# columns, a row per session and a blank one a day, students in "Section"
+# groups of 20 columns), the JSON layout to read it with (--layout), a
+# faculty calendar per group of students whose "Clinical Practice"
+# placeholders line up with the sessions, recurring weekly like the real ones,
+# and the roster tying them together (--roster).
+#
+#   python3 SyntheticCohort.py -n 500 -w 66 synthetic/
+#   python3 DentalCalendar2020.py -L synthetic/layout.json \
+#       -R synthetic/roster.json synthetic/clinic.xlsx
+
+import argparse
+from collections import Counter
+from datetime import date, datetime, timedelta
+import json
+import os
+import random
+
+import DentalCalendar2020 as dc
+
+# Students per "Section" group of columns in the Excel file
+SECTION_WIDTH = 20
+
+# Sessions of a day, in order
+SLOTS = ["AM", "PM1", "PM2"]
+
+# Clinic keys handed out by default: common ones from the catalogue, leaving
+# out PMH whose sessions have times of their own
+DEFAULT_KEYS = ["C1", "C2", "CH", "EM", "OD", "OR", "RA", "SC", "HR", "ST", "FT"]
+
+# Last students of the groups whose session times differ, see
+# DentalCalendar2020.getStartTime(); everyone after 120 has the same times
+TIME_RULE_BOUNDARIES = [30, 60, 90, 120]
+
+def groupsOf(students, groupSize):
+    """Splits the students into groups sharing a faculty calendar, never
+    putting students with different session times in the same group
+    
+    students (int)
+        Number of students
+    groupSize (int)
+        Most students per group
+    returns (list(tuple(int, int)))
+        First and last student of each group
+    """
+    groups = []
+    first = 1
+    while first <= students:
+        last = min(first + groupSize - 1, students)
+        for boundary in TIME_RULE_BOUNDARIES:
+            if first <= boundary < last:
+                last = boundary
+                break
+        groups.append((first, last))
+        first = last + 1
+    return groups
+
+def layoutOf(students, weeks, sessionsPerDay):
+    """Where the sessions are in a synthetic Excel file
+    
+    students (int)
+        Number of students
+    weeks (int)
+        Number of weeks
+    sessionsPerDay (int)
+        Sessions a day (1-3)
+    returns (list(int), list(str))
+        See DentalCalendar2020.clinicLayout()
+    """
+    # Each day's sessions are followed by a blank row
+    dayRows = sessionsPerDay + 1
+    rows = [(week * 5 + day) * dayRows + slot
+            for week in range(weeks)
+            for day in range(5)
+            for slot in range(sessionsPerDay)]
+    
+    # pandas numbers repeated headers and names empty ones after their column
+    columns = []
+    for student in range(students):
+        column = 3 + student
+        group, position = divmod(student, SECTION_WIDTH)
+        if position == 0:
+            columns.append("Section" if group == 0 else "Section.{}".format(group))
+        else:
+            columns.append("Unnamed: {}".format(column))
+    return (rows, columns)
+
+def writeWorkbook(path, students, firstMonday, weeks, sessionsPerDay, keys, seed=0):
+    """Writes a synthetic clinic Excel file, handing out clinic keys at random
+    
+    path (str)
+        Where to write it
+    students (int)
+        Number of students
+    firstMonday (date)
+        Monday of the first week
+    weeks (int)
+        Number of weeks, one after the other
+    sessionsPerDay (int)
+        Sessions a day (1-3)
+    keys (list(str))
+        Clinic keys to hand out
+    seed (int) [0]
+        Seed of the random choices
+    """
+    from openpyxl import Workbook
+    
+    chooser = random.Random(seed)
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([None] * 3 + ["Section" if student % SECTION_WIDTH == 0 else None
+                               for student in range(students)])
+    names = {number: name for (name, number) in dc.WEEKDAYS.items()}
+    for week in range(weeks):
+        for weekday in range(dc.MONDAY, dc.FRIDAY + 1):
+            day = firstMonday + timedelta(weeks=week, days=weekday)
+            for slot in SLOTS[:sessionsPerDay]:
+                sheet.append([names[weekday], datetime(day.year, day.month, day.day), slot]
+                             + [chooser.choice(keys) for _ in range(students)])
+            sheet.append([])
+    workbook.save(path)
+
+def writeTemplate(path, firstStudent, firstMonday, weeks, sessionsPerDay):
+    """Writes a synthetic faculty calendar for the group of students starting
+    at 'firstStudent': a weekly placeholder per weekday and session (with the
+    weeks whose times differ split off into events of their own), lunch every
+    day, and a seminar every Wednesday
+    
+    path (str)
+        Where to write it
+    firstStudent (int)
+        First student of the group; session times depend on the group
+    firstMonday (date)
+        Monday of the first week
+    weeks (int)
+        Number of weeks
+    sessionsPerDay (int)
+        Sessions a day (1-3)
+    """
+    from icalendar import Calendar, Event
+    
+    stamp = datetime(2020, 8, 1, tzinfo=dc.EASTERN)
+    cal = Calendar()
+    cal.add("prodid", "-//DentalCalendar2020//Synthetic cohort//EN")
+    cal.add("version", "2.0")
+    counter = 0
+    
+    def addEvent(summary, start, end, category=None, rule=None, exdates=()):
+        nonlocal counter
+        event = Event()
+        event.add("summary", summary)
+        event.add("dtstart", start)
+        event.add("dtend", end)
+        event.add("dtstamp", stamp)
+        event.add("uid", "synthetic-{}-{}".format(firstStudent, counter))
+        if rule is not None:
+            event.add("rrule", rule)
+        for exdate in exdates:
+            event.add("exdate", exdate)
+        if category is not None:
+            event.add("categories", category)
+        event.add("class", "PUBLIC")
+        event.add("created", stamp)
+        event.add("description", "")
+        event.add("last-modified", stamp)
+        event.add("priority", 5)
+        event.add("sequence", 0)
+        event.add("transp", "OPAQUE")
+        cal.add_component(event)
+        counter += 1
+    
+    def at(day, hourMinute):
+        return datetime(day.year, day.month, day.day, *hourMinute, tzinfo=dc.EASTERN)
+    
+    for weekday in range(dc.MONDAY, dc.FRIDAY + 1):
+        days = [firstMonday + timedelta(weeks=week, days=weekday) for week in range(weeks)]
+        addEvent("Lunch", at(days[0], (12, 0)), at(days[0], (12, 30)), "Lunch",
+                 {"freq": "weekly", "count": weeks})
+        if weekday == dc.WEDNESDAY:
+            addEvent("Oral Medicine and Pathology - Seminars", at(days[0], (8, 0)),
+                     at(days[0], (8, 50)), "Lecture", {"freq": "weekly", "count": weeks})
+        
+        for slot in SLOTS[:sessionsPerDay]:
+            times = [(dc.getStartTime(day.month, day.day, slot, weekday, firstStudent, "C1"),
+                      dc.getEndTime(day.month, day.day, slot, weekday, firstStudent, "C1"))
+                     for day in days]
+            usual = Counter(times).most_common(1)[0][0]
+            unusual = [(day, time) for (day, time) in zip(days, times) if time != usual]
+            addEvent("Clinical Practice", at(days[0], usual[0]), at(days[0], usual[1]),
+                     rule={"freq": "weekly", "count": weeks},
+                     exdates=[at(day, usual[0]) for (day, _) in unusual])
+            for (day, (start, end)) in unusual:
+                addEvent("Clinical Practice", at(day, start), at(day, end))
+    
+    with open(path, "wb") as handle:
+        handle.write(cal.to_ical())
+
+def writeCohort(outputDir, students=120, weeks=33, sessionsPerDay=3, keys=DEFAULT_KEYS,
+                firstMonday=date(2020, 9, 7), groupSize=30, seed=0):
+    """Writes a whole synthetic cohort, with a roster.json of it
+    
+    outputDir (str)
+        Folder to write it into (created if needed)
+    students, weeks, sessionsPerDay, keys, firstMonday, seed
+        See writeWorkbook()
+    groupSize (int) [30]
+        Most students per faculty calendar, see groupsOf()
+    returns (str, str, list(tuple(str, int, int)))
+        The Excel file, its layout file and (faculty calendar, first student,
+        last student) for each group
+    """
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+    
+    workbookPath = os.path.join(outputDir, "clinic.xlsx")
+    writeWorkbook(workbookPath, students, firstMonday, weeks, sessionsPerDay, keys, seed)
+    rows, columns = layoutOf(students, weeks, sessionsPerDay)
+    layoutPath = os.path.join(outputDir, "layout.json")
+    with open(layoutPath, "w") as handle:
+        json.dump({"rows": rows, "columns": columns}, handle)
+    
+    templates = []
+    roster = []
+    for (first, last) in groupsOf(students, groupSize):
+        name = "Synthetic Calendar {}-{}.ics".format(first, last)
+        path = os.path.join(outputDir, name)
+        writeTemplate(path, first, firstMonday, weeks, sessionsPerDay)
+        templates.append((path, first, last))
+        roster.extend({"id": student, "section": (student - 1) // SECTION_WIDTH + 1,
+                       "calendar": name}
+                      for student in range(first, last + 1))
+    with open(os.path.join(outputDir, "roster.json"), "w") as handle:
+        json.dump(roster, handle)
+    return (workbookPath, layoutPath, templates)
+
+def mondayOf(text):
+    """argparse type for the date of the first week, moved back to its Monday"""
+    day = date.fromisoformat(text)
+    return day - timedelta(days=day.weekday())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""Writes a synthetic clinic
+        Excel file, its layout and faculty calendars for testing at scale""")
+    parser.add_argument("outputDir",
+                        metavar="DIR",
+                        help="""Folder to write the cohort into""")
+    parser.add_argument("-n", "--students",
+                        metavar="int",
+                        type=int,
+                        default=120,
+                        help="""Number of students [120]""")
+    parser.add_argument("-w", "--weeks",
+                        metavar="int",
+                        type=int,
+                        default=33,
+                        help="""Number of consecutive weeks; 33 is about an
+                            academic year [33]""")
+    parser.add_argument("-d", "--sessions",
+                        metavar="int",
+                        type=int,
+                        choices=[1, 2, 3],
+                        default=3,
+                        help="""Sessions a day (AM, PM1, PM2) [3]""")
+    parser.add_argument("-k", "--keys",
+                        metavar="KEY,...",
+                        default=",".join(DEFAULT_KEYS),
+                        help="""Clinic keys to hand out at random""")
+    parser.add_argument("-f", "--first",
+                        metavar="YYYY-MM-DD",
+                        type=mondayOf,
+                        default=date(2020, 9, 7),
+                        help="""First week [2020-09-07]""")
+    parser.add_argument("-g", "--group",
+                        metavar="int",
+                        type=int,
+                        default=30,
+                        help="""Most students per faculty calendar; groups are
+                            also split where session times change (after
+                            students 30, 60, 90 and 120) [30]""")
+    parser.add_argument("--seed",
+                        metavar="int",
+                        type=int,
+                        default=0,
+                        help="""Random seed [0]""")
+    args = parser.parse_args()
+    workbookPath, layoutPath, templates = writeCohort(
+        args.outputDir, args.students, args.weeks, args.sessions, args.keys.split(","),
+        args.first, args.group, args.seed)
+    print(workbookPath)
+    print(layoutPath)
+    for (path, first, last) in templates:
+        print("{} (students {}-{})".format(path, first, last))